@@ -1,95 +1,484 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
-from heat import simheat
-from energy import calculate_energy_usage
-from waste import run_ca_final 
+from heat import simheat, render_heat
+from energy import energy_matrix, energy_summary
+from waste import run_ca_final, render_waste
 from waste import ca_step 
 from waste import wastemaker 
+import os
+import json
 import random
 import math
-import xarray as xr
-import numpy as np
-import pandas as pd
-import torch
-from model import unet
-from demo import sample
+import time
+import functools
+import traceback
+import sys
+import threading
+import climate
+from encoding import negotiate, encode_result
+from jobs import JobManager
+from graph import run_graph
+from cache import StageCache, content_key
+from incremental import apply_changes, update_heat, update_energy, update_waste
+from sweep import run_sweep, scenario_points
+from citygrid import CityGrid, as_grid
+from serving import Limiter, Readiness, check_seed, import_report
+from metrics import Trace, StackSampler, bound, span, registry, write_folded
+import kernels
+from kernels import EXACT_MODE
+from concurrent.futures import Future, ThreadPoolExecutor
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
+# CHANNELS_LAST=1 runs the unet with nhwc tensors
+channels_last = os.environ.get("CHANNELS_LAST") == "1"
+# torch and the unet are only loaded by load_model: in the background during
+# warm up, in the gunicorn master before the fork, or by the first diffusion
+# request, whichever comes first
+model = None
+batcher = None
+model_lock = threading.Lock()
 
-model = unet().to(device)
-model.load_state_dict(torch.load("model.pth", map_location=device))
-model.eval()
+def load_model():
+    # loads MODEL_PATH (default model.pth) once per process, returns the sample batcher
+    global model, batcher
+    with model_lock:
+        if batcher is None:
+            import torch
+            from model import unet
+            from demo import device, prepare_model
+            from batcher import SampleBatcher
+            # numpy stages and the unet share the cpu, so torch gets TORCH_THREADS intra-op
+            # threads (default all but one core) and the stages run on STAGE_WORKERS threads
+            torch.set_num_threads(int(os.environ.get("TORCH_THREADS", max(1, (os.cpu_count() or 2) - 1))))
+            if os.environ.get("MODEL_ARTIFACT"):
+                # folded / bf16 / int8 torchscript from export.py instead of the eager fp32 unet
+                from export import load_artifact
+                model = load_artifact(os.environ["MODEL_ARTIFACT"])
+            else:
+                net = unet().to(device)
+                net.load_state_dict(torch.load(os.environ.get("MODEL_PATH", "model.pth"), map_location=device))
+                model = prepare_model(net, channels_last)
+            # concurrent requests share unet batches, SAMPLE_BATCH caps the batch and
+            # SAMPLE_WINDOW_MS is how long the first request waits for company
+            batcher = SampleBatcher(model,
+                                    max_batch=int(os.environ.get("SAMPLE_BATCH", 8)),
+                                    window=float(os.environ.get("SAMPLE_WINDOW_MS", 50)) / 1000,
+                                    channels_last=channels_last)
+    return batcher
+
+stage_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("STAGE_WORKERS", 4)), thread_name_prefix="stage")
+
+# per stage results keyed by content, CACHE_MB of memory and optionally
+# spilled to CACHE_DIR when evicted
+stage_cache = StageCache(max_bytes=int(os.environ.get("CACHE_MB", 256)) * 2 ** 20,
+                         spill_dir=os.environ.get("CACHE_DIR") or None)
+HEAT_PARAMS = {'steps': 75, 'alpha': 0.01, 'beta': 0.01}
+WASTE_PARAMS = {'steps': 10}
+# RELAX_TOL stops heat, waste and the energy smoothing early once no cell moves
+# by that much in a step. unset runs the full step counts above
+RELAX_TOL = float(os.environ["RELAX_TOL"]) if os.environ.get("RELAX_TOL") else None
 
 app = Flask(__name__)
 CORS(app)
 
-@app.route('/api/evaluate', methods=['POST'])
-def evaluate():
-    try:
-        data = request.get_json() 
-        print("Received evaluation data:")
-        grid_size = data.get('gridSize')
-        grid = data.get('grid')
-        longitude = float(data.get('longitude')) + 180
-        latitude = float(data.get('latitude')) 
-        year = str(data.get('yr'))
-        evaluation = data.get('evaluation')
-        flat = []
-        for i in range(grid_size):
-            temp = []
-            for j in range(grid_size):
-                temp.append(grid[i][j]["type"])
-            flat.append(temp)
-        url = "https://ds.nccs.nasa.gov/thredds/dodsC/AMES/NEX/GDDP-CMIP6/ACCESS-CM2/ssp245/r1i1p1f1/tasmax/tasmax_day_ACCESS-CM2_ssp245_r1i1p1f1_gn_" + str(year) +".nc"
-        dstm = xr.open_dataset(url,engine='netcdf4' )
-        tasmax_c = dstm['tasmax']-273.15
-        latmin = dstm.lat.min().item()
-        latmax = dstm.lat.max().item()
-        lonmin = dstm.lon.min().item()
-        lonmax = dstm.lon.max().item()
-        print("Lat range:", dstm.lat.min().item(), dstm.lat.max().item())
-        print("Lon range:", dstm.lon.min().item(), dstm.lon.max().item())
-        #clamp functions because data is fucked
-        if longitude > lonmax:
-            longitude = lonmax
-        elif longitude < lonmin:
-            longitude = lonmin
-        
-        if latitude > latmax:
-            latitude = latmax
-        elif longitude < lonmin:
-            latitude = latmin
-        value = tasmax_c.sel(lat=latitude, lon=longitude, method='nearest')
-        airtemp = value.max(dim="time").item()
+STAGE_FIELDS = {
+    'heat': lambda out: {"heatmap": out[0], "heattemps": out[1], "heat_stats": out[2]},
+    'energy': lambda out: {"energy_heatmap": out[0], "energy_stats": out[1]},
+    'pollution': lambda out: {"pollution_heatmap": out[0], "pollution_stats": out[1]},
+    'diffusion': lambda out: {"diffusionresult": out[0], "seed": out[1]},
+}
+
+def diffusion_stage(grid, steps, seed, progress=None):
+    # a future of (image, seed). the sample itself runs on the batcher's thread,
+    # so nothing holds a stage thread while it waits for the unet
+    city = as_grid(grid)
+    key = content_key(content_key(city.types), steps, seed)
+    staged = Future()
+    hit, value = stage_cache.get('diffusion', key)
+    if hit:
+        staged.set_result(value)
+        return staged
+    # unseeded requests get a seed here so the cached image can report it
+    used = seed if seed is not None else random.getrandbits(63)
+    sample = load_model().submit(city, steps=steps, seed=used, progress=progress)
+
+    def finished(sample):
+        if sample.cancelled():
+            return
+        if sample.exception() is not None:
+            if staged.set_running_or_notify_cancel():
+                staged.set_exception(sample.exception())
+            return
+        value = (sample.result(), used)
+        stage_cache.put('diffusion', key, value)
+        if staged.set_running_or_notify_cancel():
+            staged.set_result(value)
+    # a request that gives up drops its sample if the batch has not started
+    staged.add_done_callback(lambda f: f.cancelled() and sample.cancel())
+    sample.add_done_callback(finished)
+    return staged
+
+def remember(result, flat, airtemp, heat_field, matrix, waste):
+    # keep the raw fields so later edits to this layout can be applied incrementally
+    result_id = content_key(flat, airtemp)
+    stage_cache.put('state', result_id, {'flat': flat, 'airtemp': airtemp, 'heat': heat_field,
+                                         'energy': matrix, 'waste': waste,
+                                         'convergence': result.get('convergence')})
+    result["result_id"] = result_id
+
+def run_evaluation(data, report=None, progress=None, trace=None):
+    # whole pipeline for one request. report(stage, partial) gets each stage's
+    # fields as soon as they exist, progress(step, total) follows the diffusion.
+    # a "base" result id plus "changes" takes the incremental path instead.
+    # every stage is a span of trace (metrics.py), jobs get a throwaway one
+    report = report or (lambda stage, partial: None)
+    trace = trace or Trace()
+    if data.get('base') and data.get('changes') is not None:
+        hit, base = stage_cache.get('state', data['base'])
+        if hit:
+            with bound(trace), span('incremental'):
+                return run_incremental(data, base, report, progress)
+        # evicted or unknown base, a full run still works if the grid came along
+        print("Unknown base result, running a full evaluation")
+    print("Received evaluation data:")
+    longitude = float(data.get('longitude')) + 180
+    latitude = float(data.get('latitude')) 
+    year = str(data.get('yr'))
+    evaluation = data.get('evaluation')
+    # diffusion steps, anything below the full T uses the strided ddim sampler
+    steps = data.get('steps')
+    steps = int(steps) if steps is not None else None
+    # parsed and encoded once, every stage reads the same CityGrid
+    with bound(trace), span('parse'):
+        city = CityGrid.from_request(data)
+    flat = city.rows
+    result = {"message": "True", "score": 2, "orgmap": flat}
+
+    def fetch_climate():
+        # local annual max store first, THREDDS only for years that were never ingested
+        airtemp = climate.airtemp(year, latitude, longitude)
 
         #if airtemp is still fucked generate random value lol
         if (math.isnan(airtemp)):
             airtemp = random.randint(0,40)
-        flatsim = simheat(flat,airtemp)
-        
-        # Calculate energy usage heatmap and statistics
-        energy_heatmap, energy_stats = calculate_energy_usage(flat)
-        difresult = sample(model,flat)
         print(airtemp)
-        pollution = run_ca_final(flat,flatsim[2]) 
-        return jsonify({
-            "message": "True",
-            "score": 2,
-            "orgmap" : flat,
-            "heatmap": flatsim[0],
-            "heattemps":flatsim[1],
-            "heat_stats":flatsim[2].tolist(),
-            "energy_heatmap": energy_heatmap,
-            "energy_stats": energy_stats,
-            "pollution_heatmap": pollution[0],
-            "pollution_stats": pollution[1].tolist(),
-            "diffusionresult":difresult
-        }), 200
-        
-    except Exception as e:
-        print("Error processing evaluation:", str(e))
+        return airtemp
+
+    # every stage is memoised on the layout plus whatever else it reads, so a
+    # new location only reruns the stages downstream of the climate value
+    layout = content_key(city.types)
+    seed = check_seed(data.get('seed'))
+
+    def energy_stage():
+        matrix = energy_matrix(city)
+        return energy_summary(matrix, city, RELAX_TOL) + (matrix,)
+
+    # only pollution needs the heat field, everything else runs side by side
+    tasks = {
+        'climate': (fetch_climate, []),
+        'heat': (lambda climate: stage_cache.memo('heat', content_key(layout, climate, HEAT_PARAMS, RELAX_TOL),
+                                                  lambda: simheat(city, climate, **HEAT_PARAMS, tol=RELAX_TOL)), ['climate']),
+        'pollution': (lambda heat, climate: stage_cache.memo('pollution', content_key(layout, climate, HEAT_PARAMS, WASTE_PARAMS, RELAX_TOL, EXACT_MODE),
+                                                             lambda: run_ca_final(city, heat[2], **WASTE_PARAMS, tol=RELAX_TOL)), ['heat', 'climate']),
+        # Calculate energy usage heatmap and statistics
+        'energy': (lambda: stage_cache.memo('energy', content_key(layout, RELAX_TOL), energy_stage), []),
+        'diffusion': (lambda: diffusion_stage(city, steps, seed, progress), []),
+    }
+    # the diffusion task only looks up the cache and queues the sample, its wall
+    # time from queueing to image goes into the trace once the graph is done
+    tasks = {name: (fn if name == 'diffusion' else trace.wrap(name, fn), deps) for name, (fn, deps) in tasks.items()}
+    def stage_done(name, out):
+        if name in STAGE_FIELDS:
+            partial = STAGE_FIELDS[name](out)
+            result.update(partial)
+            report(name, partial)
+
+    outputs, timings = run_graph(tasks, stage_pool, stage_done)
+    trace.add('diffusion', timings['diffusion'])
+    result["timings"] = {name: round(seconds * 1000, 1) for name, seconds in timings.items()}
+    # steps run and last residual per relaxation, the energy smoothing's are in energy_stats
+    result["convergence"] = {"heat": outputs['heat'][3], "pollution": outputs['pollution'][2]}
+    print("Stage timings (ms):", result["timings"])
+    remember(result, flat, outputs['climate'], outputs['heat'][2], outputs['energy'][2], outputs['pollution'][1])
+    return result
+
+def run_incremental(data, base, report=None, progress=None):
+    # base result plus a list of changed cells. heat and waste start from the
+    # stored fields and only redo the window around the edits, energy only the
+    # 5x5 neighbourhood. diffusion is skipped unless the request asks for it.
+    # with RELAX_TOL heat and waste rerun whole instead, memoised like a full
+    # evaluation: where a run stops depends on the whole field, so an edit can't
+    # be added to an early stopped base as a fixed number of steps
+    report = report or (lambda stage, partial: None)
+    start = time.perf_counter()
+    seed = check_seed(data.get('seed'))
+    flat, cells = apply_changes(base['flat'], data.get('changes') or [])
+    airtemp = base['airtemp']
+    heat_field, matrix, waste = base['heat'], base['energy'], base['waste']
+    convergence = base.get('convergence')
+    if cells and RELAX_TOL is not None:
+        city = CityGrid(flat)
+        layout = content_key(city.types)
+        heat = stage_cache.memo('heat', content_key(layout, airtemp, HEAT_PARAMS, RELAX_TOL),
+                                lambda: simheat(city, airtemp, **HEAT_PARAMS, tol=RELAX_TOL))
+        pollution = stage_cache.memo('pollution', content_key(layout, airtemp, HEAT_PARAMS, WASTE_PARAMS, RELAX_TOL, EXACT_MODE),
+                                     lambda: run_ca_final(city, heat[2], **WASTE_PARAMS, tol=RELAX_TOL))
+        heat_field, waste = heat[2], pollution[1]
+        matrix = update_energy(matrix, flat, cells)
+        convergence = {"heat": heat[3], "pollution": pollution[2]}
+        print(f"Incremental update of {len(cells)} cells, heat and waste rerun with RELAX_TOL {RELAX_TOL}")
+    elif cells:
+        heat_field, dirty, residual, heat_info = update_heat(heat_field, base['flat'], flat, cells, **HEAT_PARAMS)
+        matrix = update_energy(matrix, flat, cells)
+        waste, waste_info = update_waste(waste, flat, heat_field, dirty, **WASTE_PARAMS)
+        # the last step of the base plus that of the edit: heat's residuals add,
+        # waste's window holds every cell that moved, so both are at most this
+        convergence = {
+            "heat": {'steps': heat_info['steps'], 'converged': False,
+                     'residual': convergence['heat']['residual'] + heat_info['residual']},
+            "pollution": {'steps': waste_info['steps'], 'converged': False,
+                          'residual': max(convergence['pollution']['residual'], waste_info['residual'])},
+        }
+        print(f"Incremental update of {len(cells)} cells, heat window {dirty}, residual {residual:.2e}")
+    result = {"message": "True", "score": 2, "orgmap": flat}
+    outputs = {
+        'heat': render_heat(heat_field, airtemp),
+        'energy': energy_summary(matrix, flat, RELAX_TOL),
+        'pollution': render_waste(waste),
+    }
+    if data.get('diffusion'):
+        steps = data.get('steps')
+        outputs['diffusion'] = diffusion_stage(flat, int(steps) if steps is not None else None, seed, progress).result()
+    for name, out in outputs.items():
+        partial = STAGE_FIELDS[name](out)
+        result.update(partial)
+        report(name, partial)
+    result["timings"] = {"incremental": round((time.perf_counter() - start) * 1000, 1)}
+    # steps run and last residual per relaxation, like a full evaluation
+    result["convergence"] = convergence
+    remember(result, flat, airtemp, heat_field, matrix, waste)
+    return result
+
+# JOB_WORKERS evaluations run at once, JOB_QUEUE caps how many may wait
+jobs = JobManager(run_evaluation,
+                  max_workers=int(os.environ.get("JOB_WORKERS", 2)),
+                  max_pending=int(os.environ.get("JOB_QUEUE", 32)))
+
+# MAX_INFLIGHT synchronous evaluations/sweeps per process, past that callers get a 429
+limiter = Limiter(int(os.environ.get("MAX_INFLIGHT", 4)))
+# malformed requests surface as one of these while they are read, anything else is on us
+BAD_INPUT = (KeyError, IndexError, TypeError, ValueError, AttributeError)
+
+def limited(name):
+    def wrap(view):
+        @functools.wraps(view)
+        def guarded(*args, **kwargs):
+            if not limiter.acquire():
+                return jsonify({"error": "Server busy, retry shortly"}), 429, {"Retry-After": "1"}
+            try:
+                return view(*args, **kwargs)
+            except BAD_INPUT as e:
+                print(f"Error processing {name}:", str(e))
+                return jsonify({"error": "Invalid request"}), 400
+            except Exception:
+                traceback.print_exc()
+                return jsonify({"error": "Internal error"}), 500
+            finally:
+                limiter.release()
+        return guarded
+    return wrap
+
+def warm_up():
+    # loads the model, then a tiny evaluation through every stage plus one unet
+    # step, so lazy imports, colormap luts and the first forward pass are paid
+    # before real traffic
+    load_model()
+    from demo import sample_batch
+    city = CityGrid([['d', 'l'], ['g', 'b']])
+    heat = simheat(city, 20.0, **HEAT_PARAMS)
+    run_ca_final(city, heat[2], **WASTE_PARAMS)
+    energy_summary(energy_matrix(city), city)
+    encode_result({"heatmap": heat[0]}, 'png')
+    sample_batch(model, [city], steps=1, seeds=[0], channels_last=channels_last, show_progress=False)
+    # the backends a layout past 32x32 picks (kernels.py) get compiled and checked
+    # against python here, not under the check lock in the first big request
+    for kernel in kernels.KERNELS:
+        name = kernels.select(kernel, 33 * 33)
+        if name != 'numpy':
+            kernels.verified(kernel, name)
+
+readiness = Readiness(warm_up)
+
+@app.before_request
+def start_warm_up():
+    # no-op once this process has started warming up
+    readiness.start()
+
+# PROFILE_SLOW_MS samples every thread's stack while a request runs and keeps
+# the ones slower than that as folded stacks in PROFILE_DIR (flamegraph.pl,
+# speedscope or py-spy's raw format). PROFILE_INTERVAL_MS is the sample period
+profile_slow = os.environ.get("PROFILE_SLOW_MS")
+profile_dir = os.environ.get("PROFILE_DIR", "profiles")
+
+registry.gauge('limiter', "Synchronous requests in flight and rejected so far", 'kind',
+               limiter.summary)
+registry.gauge('cache_bytes', "Stage cache memory in use and its cap", 'kind',
+               lambda: {k: v for k, v in stage_cache.summary().items() if k in ('bytes', 'max_bytes')})
+registry.gauge('unet_batches', "Sampler batches and samples run by this process", 'kind',
+               lambda: {} if batcher is None else {'batches': batcher.batches_run, 'samples': batcher.samples_run})
+
+@app.before_request
+def start_trace():
+    g.trace = Trace()
+    g.sampler = None
+    if profile_slow and request.endpoint not in ('metrics', 'health', 'ready'):
+        g.sampler = StackSampler(float(os.environ.get("PROFILE_INTERVAL_MS", 10)) / 1000).start()
+
+@app.after_request
+def finish_trace(response):
+    # Server-Timing shows up in the browser devtools next to the request
+    trace = g.get('trace')
+    if trace is None or request.endpoint == 'metrics':
+        return response
+    seconds = time.perf_counter() - trace.start
+    response.headers['Server-Timing'] = trace.header()
+    response.headers['Timing-Allow-Origin'] = '*'
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    registry.request(route, response.status_code, seconds)
+    if g.sampler is not None:
+        stacks = g.sampler.stop()
+        if seconds * 1000 >= float(profile_slow):
+            os.makedirs(profile_dir, exist_ok=True)
+            path = os.path.join(profile_dir, f"{request.endpoint}-{os.getpid()}-{time.time_ns()}.folded")
+            write_folded(stacks, path)
+            print(f"Slow {route} ({seconds * 1000:.0f} ms), stacks in {path}")
+    return response
+
+def encode_response(data, result, route):
+    with bound(g.trace), span('encode'):
+        fmt = negotiate(data, request.headers.get('Accept'))
+        body, mimetype = encode_result(result, fmt)
+    registry.response(route, fmt, len(body))
+    return Response(body, status=200, mimetype=mimetype)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    return jsonify({"status": "ok", "pid": os.getpid(), "limiter": limiter.summary()})
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    status = readiness.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/api/evaluate', methods=['POST'])
+@limited('evaluation')
+def evaluate():
+    data = request.get_json(silent=True)
+    result = run_evaluation(data, trace=g.trace)
+    return encode_response(data, result, '/api/evaluate')
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Invalid request"}), 400
+    try:
+        # a bad seed is a 400 now rather than a failed job later
+        check_seed(data.get('seed'))
+    except (TypeError, ValueError):
         return jsonify({"error": "Invalid request"}), 400
+    job = jobs.submit(data)
+    if job is None:
+        return jsonify({"error": "Too many pending jobs"}), 429
+    return jsonify({
+        "job": job.id,
+        "status": job.status,
+        "result": f"/api/jobs/{job.id}",
+        "events": f"/api/jobs/{job.id}/events"
+    }), 202
+
+def text_format(fmt):
+    # sse is text only, so msgpack falls back to base64 buffers
+    return 'raw' if fmt == 'msgpack' else fmt
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    fmt = negotiate({'format': request.args.get('format', job.data.get('format'))}, request.headers.get('Accept'))
+    with job.cond:
+        partial = dict(job.result)
+        status = {"job": job.id, "status": job.status, "stages": list(job.stages), "progress": job.progress}
+    if fmt == 'msgpack':
+        body, mimetype = encode_result({**status, "result": partial}, fmt)
+        return Response(body, status=200, mimetype=mimetype)
+    body, _ = encode_result(partial, fmt)
+    return Response('{"status": %s, "result": %s}' % (json.dumps(status), body.decode('utf-8')),
+                    status=200, mimetype='application/json')
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    # server sent events: stage (partial result), progress (diffusion step n/T), done or error
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    fmt = text_format(negotiate({'format': request.args.get('format', job.data.get('format'))}))
+
+    def events():
+        for item in job.stream():
+            if item is None:
+                yield ": keepalive\n\n"
+                continue
+            event, payload = item
+            if event == 'stage':
+                body, _ = encode_result(payload['result'], fmt)
+                data = '{"stage": %s, "result": %s}' % (json.dumps(payload['stage']), body.decode('utf-8'))
+            else:
+                data = json.dumps(payload)
+            yield f"event: {event}\ndata: {data}\n\n"
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/sweep', methods=['POST'])
+@limited('sweep')
+def sweep():
+    # one grid against a list of {yr, latitude, longitude, scenario}, stats only.
+    # the diffusion image does not depend on the climate so it runs once if asked
+    data = request.get_json(silent=True)
+    with bound(g.trace):
+        with span('parse'):
+            city = CityGrid.from_request(data)
+            seed = check_seed(data.get('seed'))
+        start = time.perf_counter()
+        with span('sweep'):
+            result = run_sweep(city, scenario_points(data['scenarios']), HEAT_PARAMS, WASTE_PARAMS)
+        if data.get('diffusion'):
+            steps = data.get('steps')
+            with span('diffusion'):
+                result["diffusionresult"], result["seed"] = diffusion_stage(city, int(steps) if steps is not None else None, seed).result()
+    print(f"Sweep of {len(result['rows'])} scenarios in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return encode_response(data, result, '/api/sweep')
+
+@app.route('/api/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(stage_cache.summary())
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    if '--profile-startup' in sys.argv:
+        # import cost of every module backend pulls in, then the model load and warm up
+        print(import_report('backend'))
+        start = time.perf_counter()
+        load_model()
+        print(f"load_model {time.perf_counter() - start:8.2f} s")
+        start = time.perf_counter()
+        warm_up()
+        print(f"warm_up    {time.perf_counter() - start:8.2f} s")
+    else:
+        # dev server only, production runs under gunicorn (see gunicorn.conf.py)
+        readiness.start()
+        app.run(debug=True)
 
@@ -0,0 +1,87 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from demo import sample_batch
+from metrics import span
+from serving import check_seed
+
+class SampleBatcher:
+    # collects sample requests for a short window and runs them through the unet
+    # as one batch. requests only share a batch if they asked for the same steps
+    def __init__(self, model, max_batch=8, window=0.05, channels_last=False):
+        self.model = model
+        self.max_batch = max_batch
+        self.window = window
+        self.channels_last = channels_last
+        self.pending = queue.Queue()
+        self.batches_run = 0
+        self.samples_run = 0
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def ensure_worker(self):
+        # started on first use, and again in a forked child where the parent's thread is gone
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name="sample-batcher", daemon=True)
+                self.worker.start()
+
+    def submit(self, grid, steps=None, seed=None, progress=None):
+        # progress(step, total) is called from the worker thread while the batch runs
+        seed = check_seed(seed)
+        self.ensure_worker()
+        future = Future()
+        self.pending.put((grid, steps, seed, progress, future))
+        return future
+
+    def collect(self):
+        # block for the first request, then take whatever else shows up in the window
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            groups = {}
+            for item in self.collect():
+                groups.setdefault(item[1], []).append(item)
+            for steps, items in groups.items():
+                self.run_group(steps, items)
+
+    def run_group(self, steps, items):
+        items = [item for item in items if item[4].set_running_or_notify_cancel()]
+        if not items:
+            return
+        grids = [item[0] for item in items]
+        seeds = [item[2] for item in items]
+        # unseeded requests get a fresh seed so every sample still has its own generator
+        seeds = [seed if seed is not None else int(time.time_ns() % (2 ** 63)) + k for k, seed in enumerate(seeds)]
+        callbacks = [item[3] for item in items if item[3] is not None]
+
+        def progress(step, total):
+            for callback in callbacks:
+                callback(step, total)
+
+        try:
+            # the diffusion stage only waits on this, the unet time is recorded here
+            with span('unet'):
+                images = sample_batch(self.model, grids, steps=steps, seeds=seeds,
+                                      channels_last=self.channels_last, show_progress=False,
+                                      progress=progress if callbacks else None)
+        except Exception as e:
+            for item in items:
+                item[4].set_exception(e)
+            return
+        self.batches_run += 1
+        self.samples_run += len(items)
+        for item, image in zip(items, images):
+            item[4].set_result(image)
@@ -0,0 +1,248 @@
+import argparse
+import contextlib
+import fnmatch
+import functools
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from citygrid import CityGrid
+
+# micro benchmarks of the simulators and the unet plus a whole /api/evaluate through
+# the flask test client, saved as a json baseline and compared against one:
+#   python bench.py --save before.json
+#   python bench.py --compare before.json --threshold 0.15
+# the compare exits 1 if any case got slower by more than the threshold
+SIZES = (16, 32, 64, 128, 256, 512)
+AIRTEMP = 25.0
+
+def layout(size, seed=0):
+    return CityGrid(np.random.default_rng(seed).choice(list('dlgbe'), (size, size)).tolist())
+
+def measure(fn, repeat=5, min_seconds=0.5, max_runs=1000):
+    # one untimed call to warm up, then at least repeat timed ones and more until
+    # min_seconds have gone by. the median is what gets compared
+    fn()
+    times = []
+    total = 0.0
+    while len(times) < max_runs and (len(times) < repeat or total < min_seconds):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+        total += times[-1]
+    return {'median_ms': float(np.median(times)) * 1000, 'min_ms': min(times) * 1000, 'runs': len(times)}
+
+# the simulators, one case per grid size. each builds its inputs once and
+# returns the call that gets timed
+
+def simheat_case(size, opts):
+    from heat import simheat
+    city = layout(size)
+    return lambda: simheat(city, AIRTEMP)
+
+def energy_usage_case(size, opts):
+    from energy import calculate_energy_usage
+    city = layout(size)
+    return lambda: calculate_energy_usage(city)
+
+def energy_diffusion_case(size, opts):
+    from energy import energy_matrix, apply_energy_diffusion
+    city = layout(size)
+    matrix = energy_matrix(city)
+    return lambda: apply_energy_diffusion(matrix, city)
+
+def run_ca_final_case(size, opts):
+    from heat import simheat
+    from waste import run_ca_final
+    city = layout(size)
+    heat = simheat(city, AIRTEMP)[2]
+    return lambda: run_ca_final(city, heat)
+
+def render_case(size, opts):
+    # the heat and energy heatmaps from finished fields, what the colormap costs
+    from heat import simheat, render_heat
+    from energy import energy_colors
+    city = layout(size)
+    field = simheat(city, AIRTEMP)[2]
+    return lambda: (render_heat(field, AIRTEMP), energy_colors(field, field.min(), field.max()))
+
+GRID_CASES = {
+    'simheat': simheat_case,
+    'calculate_energy_usage': energy_usage_case,
+    'apply_energy_diffusion': energy_diffusion_case,
+    'run_ca_final': run_ca_final_case,
+    'render': render_case,
+}
+
+@functools.lru_cache(maxsize=None)
+def load_unet(weights):
+    # the trained weights if they are there, otherwise random ones, which take as long
+    import torch
+    from model import unet
+    from demo import device, prepare_model
+    net = unet().to(device)
+    if os.path.exists(weights):
+        net.load_state_dict(torch.load(weights, map_location=device))
+    else:
+        print(f"{weights} not found, timing the unet with random weights", file=sys.stderr)
+    return prepare_model(net)
+
+# the unet runs on a 128x128 image whatever the grid size, so these run once
+
+def unet_case(opts):
+    import torch
+    from demo import device
+    net = load_unet(opts.weights)
+    x = torch.randn(1, 3, 128, 128, device=device)
+    t = torch.full((1,), 500, device=device, dtype=torch.long)
+
+    def forward():
+        with torch.inference_mode():
+            net(x, t)
+    return forward
+
+def sample_case(opts):
+    # the strided ddim sampler at --sample-steps, the app's path for a reduced T
+    from demo import sample
+    net = load_unet(opts.weights)
+    city = layout(16)
+    return lambda: sample(net, city, steps=opts.sample_steps, seed=0, show_progress=False)
+
+MODEL_CASES = {
+    'unet': unet_case,
+    'sample': sample_case,
+}
+
+def evaluate_app(opts):
+    # backend's flask app with the climate lookup answering AIRTEMP instead of
+    # reading the store or THREDDS, and the model loaded before any timing
+    import climate
+    climate.airtemp = lambda year, lat, lon, scenario=climate.SCENARIO: AIRTEMP
+    import backend
+    from batcher import SampleBatcher
+    if backend.batcher is None and not os.path.exists("model.pth"):
+        # load_model reads model.pth from the working directory
+        backend.model = load_unet(opts.weights)
+        backend.batcher = SampleBatcher(backend.model)
+    backend.load_model()
+    backend.readiness.start()
+    backend.readiness.ready.wait()
+    return backend
+
+def evaluate_case(size, opts, cached=False):
+    from cache import StageCache
+    backend = evaluate_app(opts)
+    client = backend.app.test_client()
+    body = {'gridSize': size, 'grid': [[{'type': t, 'color': ''} for t in row] for row in layout(size).rows],
+            'longitude': 10, 'latitude': 40, 'yr': 2050, 'steps': opts.sample_steps, 'seed': 0, 'format': opts.format}
+
+    def call():
+        if not cached:
+            # every stage recomputes, like a layout the process has not seen yet
+            backend.stage_cache = StageCache()
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.post('/api/evaluate', json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/evaluate answered {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return call
+
+EVALUATE_CASES = {
+    'evaluate': evaluate_case,
+    'evaluate_cached': lambda size, opts: evaluate_case(size, opts, cached=True),
+}
+
+def cases(opts):
+    # (name, factory) for everything --only lets through
+    found = []
+    for name, make in GRID_CASES.items():
+        found.extend((f"{name}/{size}", lambda make=make, size=size: make(size, opts)) for size in opts.sizes)
+    for name, make in MODEL_CASES.items():
+        found.append((name, lambda make=make: make(opts)))
+    for name, make in EVALUATE_CASES.items():
+        found.extend((f"{name}/{size}", lambda make=make, size=size: make(size, opts)) for size in opts.sizes)
+    return [(name, make) for name, make in found if not opts.only or any(fnmatch.fnmatch(name, p) for p in opts.only)]
+
+def environment():
+    # enough to tell whether two result files are comparable at all
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    torch = sys.modules.get('torch')
+    return {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'torch': torch.__version__ if torch is not None else None,
+        'env': {k: os.environ[k] for k in ('SIM_BACKEND', 'SIM_EXACT', 'RELAX_TOL', 'TORCH_THREADS', 'CHANNELS_LAST')
+                if k in os.environ},
+    }
+
+def run(opts):
+    results = {}
+    for name, make in cases(opts):
+        results[name] = measure(make(), opts.repeat, opts.min_seconds)
+        r = results[name]
+        print(f"{name:32s} {r['median_ms']:10.2f} ms median {r['min_ms']:10.2f} ms min {r['runs']:5d} runs", flush=True)
+    return {'environment': environment(), 'results': results}
+
+def compare(baseline, current, threshold):
+    # (lines, regressions) for the cases both files have, by median
+    lines, regressions = [], []
+    for name, now in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            lines.append(f"{name:32s} {'':>10s}    {now['median_ms']:10.2f} ms   new")
+            continue
+        ratio = now['median_ms'] / before['median_ms']
+        if ratio > 1 + threshold:
+            verdict = 'SLOWER'
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            verdict = 'faster'
+        else:
+            verdict = ''
+        lines.append(f"{name:32s} {before['median_ms']:10.2f} -> {now['median_ms']:10.2f} ms {ratio:6.2f}x {verdict}")
+    for key in ('machine', 'cpus', 'numpy', 'torch', 'env'):
+        if baseline['environment'].get(key) != current['environment'].get(key):
+            lines.append(f"note: {key} differs from the baseline ({baseline['environment'].get(key)} vs "
+                         f"{current['environment'].get(key)})")
+    return lines, regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the simulators, the unet and /api/evaluate, save or compare json baselines")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="grid sizes for the per size cases")
+    parser.add_argument("--only", nargs="+", default=None, help="case name patterns, like 'simheat/*' or 'evaluate/64'")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs at least (default 5)")
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="keep timing a case until this much time went by")
+    parser.add_argument("--sample-steps", type=int, default=4, help="ddim steps for sample and evaluate (default 4)")
+    parser.add_argument("--format", default='raw', help="evaluate response format (default raw, what the site asks for)")
+    parser.add_argument("--weights", default="model.pth", help="unet weights, random ones if missing")
+    parser.add_argument("--save", default=None, help="write the results here as json")
+    parser.add_argument("--compare", default=None, help="baseline json to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative slowdown of a median that counts as a regression (default 0.10)")
+    opts = parser.parse_args()
+
+    current = run(opts)
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            json.dump(current, f, indent=2)
+        print(f"wrote {opts.save}")
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(baseline, current, opts.threshold)
+        print('\n'.join(lines))
+        if regressions:
+            print(f"{len(regressions)} case(s) more than {opts.threshold:.0%} slower: {', '.join(regressions)}")
+            sys.exit(1)
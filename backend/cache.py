@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+import numpy as np
+
+def content_key(*parts):
+    # sha256 over the json form of the parts, arrays by dtype/shape/bytes
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(f"{part.dtype}{part.shape}".encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+def size_of(value):
+    # rough bytes, good enough to bound the memory tier
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(size_of(v) for v in value) + 64
+    if isinstance(value, dict):
+        return sum(size_of(v) for v in value.values()) + 64
+    return 64
+
+class StageCache:
+    # lru over (stage, key) bounded by bytes. with a spill dir, evicted entries
+    # are pickled there and loaded back on a later hit
+    def __init__(self, max_bytes=256 * 2 ** 20, spill_dir=None, max_spill=1000):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill = max_spill
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {}
+        # spilled files oldest first, so pruning never lists the directory. files
+        # left by an earlier process join it in mtime order
+        self.spilled = OrderedDict()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            for path in sorted((os.path.join(spill_dir, name) for name in os.listdir(spill_dir) if name.endswith(".pkl")),
+                               key=os.path.getmtime):
+                self.spilled[path] = None
+
+    def count(self, stage, what):
+        counters = self.stats.setdefault(stage, {'hits': 0, 'disk_hits': 0, 'misses': 0})
+        counters[what] += 1
+
+    def spill_path(self, stage, key):
+        return os.path.join(self.spill_dir, f"{stage}-{key}.pkl")
+
+    def get(self, stage, key):
+        with self.lock:
+            if (stage, key) in self.entries:
+                self.entries.move_to_end((stage, key))
+                self.count(stage, 'hits')
+                return True, self.entries[(stage, key)][0]
+        if self.spill_dir and os.path.exists(self.spill_path(stage, key)):
+            try:
+                with open(self.spill_path(stage, key), 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                value = None
+            else:
+                with self.lock:
+                    self.count(stage, 'disk_hits')
+                self.put(stage, key, value)
+                return True, value
+        with self.lock:
+            self.count(stage, 'misses')
+        return False, None
+
+    def put(self, stage, key, value):
+        size = size_of(value)
+        evicted = []
+        with self.lock:
+            if (stage, key) in self.entries:
+                self.bytes -= self.entries.pop((stage, key))[1]
+            self.entries[(stage, key)] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, (old_value, old_size) = self.entries.popitem(last=False)
+                self.bytes -= old_size
+                evicted.append((old_key, old_value))
+        if self.spill_dir:
+            for (old_stage, old_key), old_value in evicted:
+                self.spill(old_stage, old_key, old_value)
+
+    def spill(self, stage, key, value):
+        # pickled outside the lock into a file of this thread's own, then moved
+        # into place and the oldest files pruned under it, so the index and the
+        # directory agree. a file someone else already removed is fine
+        path = self.spill_path(stage, key)
+        scratch = f"{path}.{threading.get_ident()}.tmp"
+        with open(scratch, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            os.replace(scratch, path)
+            self.spilled[path] = None
+            self.spilled.move_to_end(path)
+            while len(self.spilled) > self.max_spill:
+                old, _ = self.spilled.popitem(last=False)
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+
+    def memo(self, stage, key, compute):
+        # cached value for (stage, key), computing and storing it on a miss
+        hit, value = self.get(stage, key)
+        if not hit:
+            value = compute()
+            self.put(stage, key, value)
+        return value
+
+    def summary(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'stages': {stage: dict(counters) for stage, counters in self.stats.items()}}
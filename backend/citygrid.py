@@ -0,0 +1,56 @@
+import numpy as np
+
+# type codes shared by every simulator. 'empty' is what the builder sends for an
+# unpainted cell; 'e' (empty land) and anything unknown fold into it. the
+# simulations give it no demand, waste or heat offset, the diffusion model
+# paints it red
+TYPES = ('empty', 'd', 'l', 'g', 'b')
+EMPTY, DENSE, LIGHT, GREEN, WATER = range(len(TYPES))
+TYPE_CODE = {name: code for code, name in enumerate(TYPES)}
+
+def encode(grid):
+    return np.array([[TYPE_CODE.get(cell, EMPTY) for cell in row] for row in grid], dtype=np.uint8)
+
+class CityGrid:
+    # one layout, parsed once per request: uint8 codes, one-hot masks and per type
+    # counts. rows keeps what the client sent so it can be echoed back as is
+    def __init__(self, rows=None, types=None):
+        self.rows = rows
+        self.types = np.ascontiguousarray(encode(rows) if types is None else types, dtype=np.uint8)
+        self.onehot = self.types == np.arange(len(TYPES), dtype=np.uint8)[:, None, None]
+        self.counts = np.bincount(self.types.ravel(), minlength=len(TYPES))
+        if self.rows is None:
+            self.rows = [[TYPES[code] for code in row] for row in self.types.tolist()]
+
+    @classmethod
+    def from_request(cls, data):
+        size = data.get('gridSize')
+        grid = data.get('grid')
+        return cls([[grid[i][j]["type"] for j in range(size)] for i in range(size)])
+
+    @property
+    def shape(self):
+        return self.types.shape
+
+    def mask(self, code):
+        return self.onehot[code]
+
+    def count(self, code):
+        return int(self.counts[code])
+
+    def numpy(self):
+        return self.types
+
+    def torch(self, device=None):
+        # shares memory with types on the cpu
+        import torch
+        tensor = torch.from_numpy(self.types)
+        return tensor if device is None else tensor.to(device)
+
+def as_grid(grid):
+    # simulators take a CityGrid, a list of rows of type names or a code array
+    if isinstance(grid, CityGrid):
+        return grid
+    if isinstance(grid, np.ndarray) and grid.dtype == np.uint8:
+        return CityGrid(types=grid)
+    return CityGrid(grid)
@@ -0,0 +1,117 @@
+import argparse
+import os
+from functools import lru_cache
+import numpy as np
+
+# {year} and {scenario} get filled in. CLIMATE_URL points it somewhere else, like the
+# stand-in loadtest.py runs (plain http files need a #mode=bytes suffix for netcdf)
+URL = os.environ.get("CLIMATE_URL") or "https://ds.nccs.nasa.gov/thredds/dodsC/AMES/NEX/GDDP-CMIP6/ACCESS-CM2/{scenario}/r1i1p1f1/tasmax/tasmax_day_ACCESS-CM2_{scenario}_r1i1p1f1_gn_{year}.nc"
+SCENARIO = "ssp245"
+# annual max grids live here as tasmax_<year>.npy (celsius) + tasmax_<year>_axes.npz (lat/lon),
+# other scenarios than the default as tasmax_<scenario>_<year>...
+CLIMATE_DIR = os.environ.get("CLIMATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "climate_cache"))
+_grids = {}
+
+def paths(year, root=None, scenario=SCENARIO):
+    root = root or CLIMATE_DIR
+    # default scenario keeps the original names so existing stores still load
+    stem = os.path.join(root, f"tasmax_{year}" if scenario == SCENARIO else f"tasmax_{scenario}_{year}")
+    return (stem + ".npy", stem + "_axes.npz")
+
+def load_year(year, root=None, scenario=SCENARIO):
+    # memory mapped annual max grid for the year, None if it was never ingested
+    key = (str(year), root or CLIMATE_DIR, scenario)
+    if key not in _grids:
+        grid_path, axes_path = paths(year, root, scenario)
+        if not (os.path.exists(grid_path) and os.path.exists(axes_path)):
+            return None
+        axes = np.load(axes_path)
+        _grids[key] = (axes["lat"], axes["lon"], np.load(grid_path, mmap_mode="r"))
+    return _grids[key]
+
+def nearest(axis, value):
+    # same pick as xarray sel(method='nearest') on a sorted axis
+    i = int(np.clip(np.searchsorted(axis, value), 1, len(axis) - 1))
+    return i if abs(axis[i] - value) < abs(axis[i - 1] - value) else i - 1
+
+def fetch_points(year, lats, lons, source=None, scenario=SCENARIO):
+    # old path: open the remote year and reduce the whole time series, but for
+    # every point of the year in one selection
+    import xarray as xr
+    ds = xr.open_dataset(source or URL.format(year=year, scenario=scenario), engine='netcdf4')
+    tasmax_c = ds['tasmax'] - 273.15
+    picked = tasmax_c.sel(lat=xr.DataArray(list(lats), dims="point"),
+                          lon=xr.DataArray(list(lons), dims="point"), method='nearest')
+    return [float(v) for v in picked.max(dim="time").values]
+
+def fetch_point(year, lat, lon, source=None, scenario=SCENARIO):
+    return fetch_points(year, [lat], [lon], source, scenario)[0]
+
+@lru_cache(maxsize=4096)
+def airtemp(year, lat, lon, scenario=SCENARIO):
+    # annual max tasmax in celsius, local store first and the network only on a miss
+    local = load_year(year, scenario=scenario)
+    if local is None:
+        return fetch_point(year, lat, lon, scenario=scenario)
+    lats, lons, grid = local
+    return float(grid[nearest(lats, lat), nearest(lons, lon)])
+
+def airtemps(points):
+    # bulk airtemp for (year, lat, lon, scenario) tuples: cached points are free,
+    # the rest are grouped so each year is opened once
+    out = [None] * len(points)
+    groups = {}
+    for k, (year, lat, lon, scenario) in enumerate(points):
+        local = load_year(year, scenario=scenario)
+        if local is not None:
+            out[k] = airtemp(str(year), lat, lon, scenario)
+        else:
+            groups.setdefault((str(year), scenario), []).append(k)
+    for (year, scenario), indices in groups.items():
+        values = fetch_points(year, [points[k][1] for k in indices], [points[k][2] for k in indices], scenario=scenario)
+        for k, value in zip(indices, values):
+            out[k] = value
+    return out
+
+def ingest(year, source=None, root=None, chunk=31, scenario=SCENARIO):
+    # reduce tasmax over the year a month at a time so the full series never sits in memory
+    import xarray as xr
+    root = root or CLIMATE_DIR
+    os.makedirs(root, exist_ok=True)
+    ds = xr.open_dataset(source or URL.format(year=year, scenario=scenario), engine='netcdf4')
+    tasmax = ds['tasmax']
+    annual = None
+    for start in range(0, tasmax.sizes['time'], chunk):
+        part = tasmax.isel(time=slice(start, start + chunk)).max(dim="time").values
+        annual = part if annual is None else np.fmax(annual, part)
+    grid_path, axes_path = paths(year, root, scenario)
+    # write to temp names first so a half written year is never picked up
+    np.save(grid_path + ".tmp.npy", (annual - 273.15).astype(np.float32))
+    np.savez(axes_path + ".tmp.npz", lat=ds.lat.values, lon=ds.lon.values)
+    os.replace(grid_path + ".tmp.npy", grid_path)
+    os.replace(axes_path + ".tmp.npz", axes_path)
+    _grids.pop((str(year), root, scenario), None)
+    airtemp.cache_clear()
+    return grid_path
+
+def parse_years(specs):
+    years = []
+    for spec in specs:
+        if '-' in spec:
+            first, last = spec.split('-')
+            years.extend(range(int(first), int(last) + 1))
+        else:
+            years.append(int(spec))
+    return years
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pull CMIP6 tasmax annual max grids into the local climate store")
+    parser.add_argument("years", nargs="+", help="years or ranges like 2016-2100")
+    parser.add_argument("--dir", default=None, help="store directory (default CLIMATE_DIR)")
+    parser.add_argument("--source", default=None, help="local file template with {year}, e.g. fixtures/tasmax_{year}.nc")
+    parser.add_argument("--scenario", default=SCENARIO, help="CMIP6 experiment, e.g. ssp245 or ssp585")
+    args = parser.parse_args()
+    for year in parse_years(args.years):
+        source = args.source.format(year=year) if args.source else None
+        print(f"Ingesting {year}...")
+        print("Wrote", ingest(year, source=source, root=args.dir, scenario=args.scenario))
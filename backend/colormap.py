@@ -0,0 +1,38 @@
+import numpy as np
+from metrics import span
+
+# the colormaps the heatmaps use, everything else has to be added here first
+NAMES = ('inferno', 'magma', 'YlOrBr', 'Blues_r')
+_luts = {}
+
+def lut(name):
+    # 256 rgb entries per colormap, pulled out of matplotlib once and reused
+    if name not in _luts:
+        if name not in NAMES:
+            raise KeyError("unknown colormap: " + name)
+        from matplotlib import colormaps
+        _luts[name] = colormaps[name].resampled(256)(np.arange(256), bytes=True)[:, :3]
+    return _luts[name]
+
+def colorize(values, name, vmin=None, vmax=None):
+    # same binning as imshow with nearest interpolation: normalize to [0, 1],
+    # take 256 equal bins, out of range values stick to the end colors
+    with span('rasterize'):
+        values = np.asarray(values, dtype=float)
+        vmin = values.min() if vmin is None else vmin
+        vmax = values.max() if vmax is None else vmax
+        if vmax > vmin:
+            scaled = (values - vmin) / (vmax - vmin) * 256
+        else:
+            scaled = np.zeros_like(values)
+        index = np.clip(np.nan_to_num(scaled), 0, 255).astype(np.uint8)
+        return lut(name)[index]
+
+def rgb_bytes(image):
+    # float rgb in [0, 1] to uint8, the way imshow draws it
+    with span('rasterize'):
+        return (np.clip(np.asarray(image, dtype=float), 0, 1) * 255).astype(np.uint8)
+
+def to_pixels(rgb):
+    # nested [r, g, b] lists for the json response
+    return rgb.tolist()
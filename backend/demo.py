@@ -1,11 +1,10 @@
+import math
 import torch
-from torchvision.utils import save_image
-import matplotlib.pyplot as plt
 import numpy as np
-from tqdm import tqdm
 from model import unet
 from scheduler import *
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from colormap import rgb_bytes
+from citygrid import TYPES, as_grid
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -15,62 +14,118 @@ CHAR_TO_RGB = {
     "d": (0.29,  0.34,  0.39),   # dark gray
     "g": (0.0,   1.0,   0.0),    # green
 }
+# [-1, 1] color per type code, empty and unknown tiles are red
+PALETTE = torch.tensor([CHAR_TO_RGB.get(name, (1.0, 0.0, 0.0)) for name in TYPES], dtype=torch.float32) * 2 - 1
 
-@torch.no_grad()
-def sample(model, grid, img_size=128):
-    #this merges the garbage toghet
-    x = torch.randn(1, 3, img_size, img_size, device=device)
-    grid_h = len(grid)
-    grid_w = len(grid[0]) if grid_h > 0 else 0
-    if grid_h > 0 and grid_w > 0:
-        cell_h = img_size // grid_h
-        cell_w = img_size // grid_w
-        grid_tensor = torch.zeros(3, grid_h * cell_h, grid_w * cell_w, device=device)
-        for i in range(grid_h):
-            for j in range(grid_w):
-                ch = grid[i][j]
-                color = CHAR_TO_RGB.get(ch, (1.0, 0.0, 0.0))  # fallback red
-                c = torch.tensor(color, dtype=torch.float32, device=device) * 2 - 1
-                y0, y1 = i * cell_h, (i + 1) * cell_h
-                x0, x1 = j * cell_w, (j + 1) * cell_w
-                grid_tensor[:, y0:y1, x0:x1] = c.view(3, 1, 1)
+def steps_iter(ts, desc, show_progress):
+    if not show_progress:
+        return ts
+    from tqdm import tqdm
+    return tqdm(ts, desc=desc)
 
-        x[:, :, 0 : grid_h * cell_h, 0 : grid_w * cell_w] = grid_tensor
+def noise(batch_size, shape, generators=None):
+    if generators is None:
+        return torch.randn(batch_size, *shape, device=device)
+    return torch.stack([torch.randn(*shape, generator=g, device=device) for g in generators])
 
-    for t in tqdm(reversed(range(T)), desc="Sampling"):
+def ddpm_loop(model, x, show_progress=True, generators=None, progress=None):
+    state = sampler_state(x.device)
+    for n, t in enumerate(steps_iter(reversed(range(T)), "Sampling", show_progress)):
         #crazy math stuff to undo the noise
-        t_batch = torch.full((1,), t, device=device, dtype=torch.long)
-        noise_pred = model(x, t_batch)
-        sqrt_acp = get_index_from_list(sqrt_alphas_cumprod, t_batch, x.shape)
-        sqrt_1macp = get_index_from_list(sqrt_one_minus_alphas_cumprod, t_batch, x.shape)
-        x0_pred = (x - sqrt_1macp * noise_pred) / sqrt_acp
+        noise_pred = model(x, state.t_batch(t, x.shape[0]))
+        x0_pred = (x - state.sqrt_one_minus_alphas_cumprod_t[t] * noise_pred) / state.sqrt_alphas_cumprod_t[t]
         x0_pred = x0_pred.clamp(-1, 1)
-        beta_t = get_index_from_list(betas, t_batch, x.shape)
-        acp_prev = get_index_from_list(alphas_cumprod_prev, t_batch, x.shape)
-        alpha_t = get_index_from_list(alphas, t_batch, x.shape)
-
-        coef1 = (beta_t * torch.sqrt(acp_prev)) / (1.0 - get_index_from_list(alphas_cumprod, t_batch, x.shape))
-        coef2 = ((1.0 - acp_prev) * torch.sqrt(alpha_t)) / (1.0 - get_index_from_list(alphas_cumprod, t_batch, x.shape))
-        posterior_mean = coef1 * x0_pred + coef2 * x
+        posterior_mean = state.posterior_mean_coef1_t[t] * x0_pred + state.posterior_mean_coef2_t[t] * x
         if t > 0:
-            var = get_index_from_list(posterior_variance, t_batch, x.shape)
-            noise = torch.randn_like(x)
-            x = posterior_mean + torch.sqrt(var) * noise
+            z = torch.randn_like(x) if generators is None else noise(x.shape[0], x.shape[1:], generators)
+            x = posterior_mean + state.posterior_std_t[t] * z
         else:
             x = posterior_mean
+        if progress is not None:
+            progress(n + 1, T)
+    return x
+
+def ddim_loop(model, x, steps, show_progress=True, progress=None):
+    # eta = 0 ddim, reuses the ddpm weights since it only needs alphas_cumprod
+    state = sampler_state(x.device)
+    ts = ddim_timesteps(steps).tolist()
+    for i, t in enumerate(steps_iter(ts, "Sampling (ddim)", show_progress)):
+        noise_pred = model(x, state.t_batch(t, x.shape[0]))
+        acp = state.alphas_cumprod_t[t]
+        acp_prev = state.alphas_cumprod_t[ts[i + 1]] if i + 1 < len(ts) else 1.0
+        x0_pred = (x - math.sqrt(1.0 - acp) * noise_pred) / math.sqrt(acp)
+        x0_pred = x0_pred.clamp(-1, 1)
+        x = math.sqrt(acp_prev) * x0_pred + math.sqrt(1.0 - acp_prev) * noise_pred
+        if progress is not None:
+            progress(i + 1, len(ts))
+    return x
+
+def prepare_model(model, channels_last=False):
+    # eval mode, and optionally nhwc weights which the cpu conv kernels tend to prefer
+    model.eval()
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model
+
+def paint_grid(x, grid, img_size=128):
+    #this merges the garbage toghet
+    # every cell becomes a cell_h x cell_w block of its type's color
+    city = as_grid(grid)
+    if city.types.size > 0:
+        grid_h, grid_w = city.shape
+        cell_h = img_size // grid_h
+        cell_w = img_size // grid_w
+        types = city.torch(x.device).long()
+        if cell_h == 0 or cell_w == 0:
+            # more cells than pixels: every pixel takes the cell under it instead
+            rows = torch.arange(img_size, device=x.device) * grid_h // img_size
+            cols = torch.arange(img_size, device=x.device) * grid_w // img_size
+            x[:] = PALETTE.to(x.device)[types[rows][:, cols]].permute(2, 0, 1)
+            return x
+        colors = PALETTE.to(x.device)[types].permute(2, 0, 1)
+        x[:, 0 : grid_h * cell_h, 0 : grid_w * cell_w] = colors.repeat_interleave(cell_h, 1).repeat_interleave(cell_w, 2)
+    return x
+
+@torch.inference_mode()
+def sample_batch(model, grids, img_size=128, steps=None, seeds=None, channels_last=False, show_progress=True, progress=None):
+    # one reverse process for a stack of grids. with seeds every sample draws its
+    # noise from its own generator, so an image does not depend on what it was batched with.
+    # progress(step, total) is called after every reverse step
+    generators = None
+    if seeds is not None:
+        generators = [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
+    x = noise(len(grids), (3, img_size, img_size), generators)
+    for k, grid in enumerate(grids):
+        paint_grid(x[k], grid, img_size)
+
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+    if steps is not None and steps < T:
+        x = ddim_loop(model, x, steps, show_progress, progress)
+    else:
+        x = ddpm_loop(model, x, show_progress, generators, progress)
 
     x = (x.clamp(-1, 1) + 1) * 0.5
-    canvas_img = np.transpose(x[0].cpu().numpy(), (1, 2, 0))
+    canvas_imgs = np.transpose(x.cpu().numpy(), (0, 2, 3, 1))
+
+    return [rgb_bytes(canvas_img) for canvas_img in canvas_imgs]
 
-    height, width = img_size, img_size
-    fig = plt.figure(figsize=(width / 100, height / 100), dpi=100)
-    ax = fig.add_axes([0, 0, 1, 1])
-    ax.imshow(canvas_img)
-    ax.axis('off')
-    canvas = FigureCanvas(fig)
-    canvas.draw()
-    image = np.frombuffer(canvas.tostring_argb(), dtype=np.uint8).reshape((height, width, 4))
-    rgb_pixels = [[[int(pixel[1]), int(pixel[2]), int(pixel[3])] for pixel in row] for row in image]
-    plt.close(fig)
-    return rgb_pixels
+def sample(model, grid, img_size=128, steps=None, seed=None, channels_last=False, show_progress=True):
+    # steps below T switches to the deterministic ddim sampler on a strided schedule
+    seeds = None if seed is None else [seed]
+    return sample_batch(model, [grid], img_size, steps, seeds, channels_last, show_progress)[0]
 
+if __name__ == '__main__':
+    # latency against step count: python demo.py [steps ...] [--channels-last]
+    import sys
+    import time
+    channels_last = "--channels-last" in sys.argv
+    model = unet().to(device)
+    model.load_state_dict(torch.load("model.pth", map_location=device))
+    prepare_model(model, channels_last)
+    grid = [['ldbg'[(i + j) % 4] for j in range(16)] for i in range(16)]
+    for steps in [int(a) for a in sys.argv[1:] if a.isdigit()] or [25, 50, 100, 250, T]:
+        start = time.perf_counter()
+        sample(model, grid, steps=steps, channels_last=channels_last, show_progress=False)
+        elapsed = time.perf_counter() - start
+        print(f"{steps:5d} steps {elapsed:8.2f} s {elapsed / steps * 1000:8.1f} ms/step")
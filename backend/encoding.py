@@ -0,0 +1,104 @@
+import base64
+import json
+import struct
+import time
+import zlib
+import numpy as np
+from colormap import to_pixels
+
+# json is the old nested list response and stays the default
+FORMATS = ('json', 'raw', 'png', 'msgpack')
+IMAGE_KEYS = ('heatmap', 'energy_heatmap', 'pollution_heatmap', 'diffusionresult')
+ARRAY_KEYS = ('heattemps', 'heat_stats', 'pollution_stats')
+
+def negotiate(data, accept=''):
+    # explicit "format" in the body wins, then the Accept header
+    fmt = (data or {}).get('format')
+    if fmt is None and 'application/msgpack' in (accept or ''):
+        fmt = 'msgpack'
+    if fmt not in FORMATS:
+        return 'json'
+    if fmt == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            return 'raw'
+    return fmt
+
+def png_bytes(rgb):
+    # minimal 8 bit rgb png, every scanline gets filter type 0
+    height, width, _ = rgb.shape
+    scanlines = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, -1)], axis=1)
+
+    def chunk(tag, body):
+        return struct.pack('>I', len(body)) + tag + body + struct.pack('>I', zlib.crc32(tag + body))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6)) + chunk(b'IEND', b''))
+
+def pack(arr, dtype, binary):
+    arr = np.ascontiguousarray(arr, dtype=dtype)
+    data = arr.astype(arr.dtype.newbyteorder('<')).tobytes()
+    return {
+        'dtype': np.dtype(dtype).name,
+        'shape': list(arr.shape),
+        'data': data if binary else base64.b64encode(data).decode('ascii'),
+    }
+
+def encode_result(result, fmt='json'):
+    # returns (body bytes, mimetype)
+    out = dict(result)
+    binary = fmt == 'msgpack'
+    for key in IMAGE_KEYS:
+        if key not in out:
+            continue
+        if fmt == 'json':
+            out[key] = to_pixels(np.asarray(out[key]))
+        elif fmt == 'png':
+            out[key] = {'dtype': 'uint8', 'shape': list(np.shape(out[key])), 'encoding': 'png',
+                        'data': base64.b64encode(png_bytes(out[key])).decode('ascii')}
+        else:
+            out[key] = pack(out[key], np.uint8, binary)
+    for key in ARRAY_KEYS:
+        if key not in out:
+            continue
+        if fmt == 'json':
+            out[key] = np.asarray(out[key], dtype=float).tolist()
+        else:
+            out[key] = pack(out[key], np.float32, binary)
+    if fmt != 'json':
+        out['format'] = fmt
+    if binary:
+        import msgpack
+        return msgpack.packb(out), 'application/msgpack'
+    return json.dumps(out).encode('utf-8'), 'application/json'
+
+def measure(result, formats=FORMATS):
+    # payload bytes and encode milliseconds per format
+    sizes = {}
+    for fmt in formats:
+        start = time.perf_counter()
+        body, _ = encode_result(result, fmt)
+        sizes[fmt] = (len(body), (time.perf_counter() - start) * 1000)
+    return sizes
+
+if __name__ == '__main__':
+    import sys
+    from heat import simheat
+    from energy import calculate_energy_usage
+    from waste import run_ca_final
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    rng = np.random.default_rng(0)
+    grid = rng.choice(list('ldbg'), size=(size, size)).tolist()
+    heat = simheat(grid, 25.0)
+    energy = calculate_energy_usage(grid)
+    pollution = run_ca_final(grid, heat[2])
+    result = {
+        "heatmap": heat[0], "heattemps": heat[1], "heat_stats": heat[2],
+        "energy_heatmap": energy[0], "energy_stats": energy[1],
+        "pollution_heatmap": pollution[0], "pollution_stats": pollution[1],
+        "diffusionresult": rng.integers(0, 256, (128, 128, 3), dtype=np.uint8),
+    }
+    for fmt, (nbytes, ms) in measure(result, [f for f in FORMATS if negotiate({'format': f}) == f]).items():
+        print(f"{fmt:8s} {nbytes:>10d} bytes {ms:8.1f} ms")
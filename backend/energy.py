@@ -1,99 +1,92 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from colormap import colorize
+from citygrid import TYPES, DENSE, LIGHT, GREEN, WATER, as_grid
+from relax import relax, relaxation_step, EdgeLaplacian, CHECK_EVERY
+
+def window_sum(plane, radius):
+    # box sum over the clipped (2r+1)x(2r+1) window via a summed-area table
+    height, width = plane.shape
+    sat = np.zeros((height + 1, width + 1))
+    sat[1:, 1:] = plane.cumsum(0).cumsum(1)
+    y0 = np.clip(np.arange(height) - radius, 0, height)[:, None]
+    y1 = np.clip(np.arange(height) + radius + 1, 0, height)[:, None]
+    x0 = np.clip(np.arange(width) - radius, 0, width)[None, :]
+    x1 = np.clip(np.arange(width) + radius + 1, 0, width)[None, :]
+    return sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
 
 def calculate_energy_usage(grid, cool_roofs=None):
-    height = len(grid)
-    width = len(grid[0])
-    
-    cell_area = 100
-
-    initial_energy_demand = {
-        'l': 60.0,   
-        'd': 160.0,  
-        'b': 0.0,    
-        'g': 0.0,   
-        'e': 0.0     
-    }
+    city = as_grid(grid)
+    return energy_summary(energy_matrix(city, cool_roofs), city)
 
-    base_energy_values = {k: v * cell_area / 365.0 for k, v in initial_energy_demand.items()}  # converted to daily kWh
-    
-    energy_matrix = np.zeros((height, width), dtype=float)
-    
-    for y in range(height):
-        for x in range(width):
-            cell_type = grid[y][x]
-            energy_matrix[y, x] = base_energy_values.get(cell_type, 0.0)
-
-    for y in range(height):
-        for x in range(width):
-            ymin = max(y - 2, 0)
-            ymax = min(y + 3, height)  # +3 because range is exclusive
-            xmin = max(x - 2, 0)
-            xmax = min(x + 3, width)
-            
-            high_density_neighbors = 0
-            green_space_neighbors = 0
-            water_neighbors = 0
-            total_neighbors = 0
-            
-            for ny in range(ymin, ymax):
-                for nx in range(xmin, xmax):
-                    if nx == x and ny == y:
-                        continue
-                    # the rules
-                    total_neighbors += 1
-                    if grid[ny][nx] == 'd':
-                        high_density_neighbors += 1
-                    elif grid[ny][nx] == 'g':  
-                        green_space_neighbors += 1
-                    elif grid[ny][nx] == 'b':  
-                        water_neighbors += 1
-
-            if total_neighbors > 0:
-                if high_density_neighbors >= total_neighbors / 2:
-                    energy_matrix[y, x] *= 1.04
-                
-                green_multiplier = 1.0
-                water_multiplier = 1.0
-                
-                green_space_percentage = green_space_neighbors / total_neighbors
-                if green_space_percentage >= 0.20:
-                    green_multiplier = 0.97
-                
-                water_percentage = water_neighbors / total_neighbors
-                if water_percentage >= 0.10:
-                    water_multiplier = 0.92
-                
-                combined_multiplier = green_multiplier * water_multiplier
-                if combined_multiplier < 0.88:
-                    combined_multiplier = 0.88
-                
-                energy_matrix[y, x] *= combined_multiplier
+CELL_AREA = 100
+
+INITIAL_ENERGY_DEMAND = {
+    'l': 60.0,   
+    'd': 160.0,  
+    'b': 0.0,    
+    'g': 0.0,   
+    'e': 0.0     
+}
+
+def energy_matrix(grid, cool_roofs=None):
+    # per cell daily kWh after the neighbourhood rules, before any smoothing
+    base_energy_values = {k: v * CELL_AREA / 365.0 for k, v in INITIAL_ENERGY_DEMAND.items()}  # converted to daily kWh
+    
+    city = as_grid(grid)
+    low = city.mask(LIGHT)
+    high = city.mask(DENSE)
+    green = city.mask(GREEN)
+    water = city.mask(WATER)
+    housing = low | high
+
+    energy_matrix = np.zeros(city.shape, dtype=float)
+    energy_matrix[low] = base_energy_values['l']
+    energy_matrix[high] = base_energy_values['d']
+
+    # 5x5 neighbourhood counts, minus the cell itself
+    total_neighbors = window_sum(np.ones(city.shape), 2) - 1
+    high_density_neighbors = window_sum(high, 2) - high
+    green_space_neighbors = window_sum(green, 2) - green
+    water_neighbors = window_sum(water, 2) - water
+
+    has_neighbors = total_neighbors > 0
+    safe_total = np.where(has_neighbors, total_neighbors, 1)
+    # the rules
+    crowded = has_neighbors & (high_density_neighbors >= safe_total / 2)
+    energy_matrix[crowded] *= 1.04
+
+    green_multiplier = np.where(green_space_neighbors / safe_total >= 0.20, 0.97, 1.0)
+    water_multiplier = np.where(water_neighbors / safe_total >= 0.10, 0.92, 1.0)
+    combined_multiplier = np.maximum(green_multiplier * water_multiplier, 0.88)
+    energy_matrix[has_neighbors] *= combined_multiplier[has_neighbors]
     
     if cool_roofs is not None:
-        for y in range(height):
-            for x in range(width):
-                if cool_roofs[y][x] and grid[y][x] in ['l', 'd']:  
-                    energy_matrix[y, x] *= 0.85  
-    
-    for y in range(height):
-        for x in range(width):
-            cell_type = grid[y][x]
-            if cell_type in ['l', 'd']: 
-                baseline_energy = base_energy_values[cell_type]
-                min_allowed_energy = baseline_energy * 0.88 
-                if energy_matrix[y, x] < min_allowed_energy:
-                    energy_matrix[y, x] = min_allowed_energy
-
-    total_energy = np.sum(energy_matrix)
-    low_density_energy = np.sum(energy_matrix[np.array([[grid[y][x] == 'l' for x in range(width)] for y in range(height)])])
-    high_density_energy = np.sum(energy_matrix[np.array([[grid[y][x] == 'd' for x in range(width)] for y in range(height)])])
+        roofed = np.asarray(cool_roofs, dtype=bool) & housing
+        energy_matrix[roofed] *= 0.85  
     
-    low_density_count = sum(row.count('l') for row in grid)
-    high_density_count = sum(row.count('d') for row in grid)
+    baseline_energy = np.where(high, base_energy_values['d'], base_energy_values['l'])
+    min_allowed_energy = baseline_energy * 0.88 
+    return np.where(housing, np.maximum(energy_matrix, min_allowed_energy), energy_matrix)
+
+def energy_summary(energy_matrix, grid, tol=None):
+    # (heatmap, stats) for a finished energy matrix. the stats also say how many
+    # smoothing steps ran and what the last residual was
+    city = as_grid(grid)
+    low = city.mask(LIGHT)
+    high = city.mask(DENSE)
+
+    energy_stats = energy_stats_from(np.sum(energy_matrix), np.sum(energy_matrix[low]), np.sum(energy_matrix[high]),
+                                     city.count(LIGHT), city.count(DENSE))
+    smoothed_energy, info = smooth_energy(energy_matrix, city, tol=tol)
+    energy_stats['diffusion_steps'] = info['steps']
+    energy_stats['diffusion_residual'] = info['residual']
+    energy_heatmap_rgb = energy_colors(smoothed_energy, smoothed_energy.min(), smoothed_energy.max())
     
-    energy_stats = {
+    return energy_heatmap_rgb, energy_stats
+
+def energy_stats_from(total_energy, low_density_energy, high_density_energy, low_density_count, high_density_count):
+    # the stats dict from sums and counts, which tiles.py adds up tile by tile
+    return {
         'total_energy_usage': float(total_energy),
         'low_density_energy': float(low_density_energy),
         'high_density_energy': float(high_density_energy),
@@ -103,107 +96,83 @@ def calculate_energy_usage(grid, cool_roofs=None):
         'avg_energy_per_high_density': float(high_density_energy / max(high_density_count, 1)),
         'energy_efficiency_ratio': float(low_density_energy / max(high_density_energy, 1))
     }
-    
-    energy_heatmap_rgb = generate_energy_heatmap(energy_matrix, grid)
-    
-    return energy_heatmap_rgb, energy_stats
 
-def apply_energy_diffusion(energy_matrix, grid, steps=50, alpha=0.02, beta=0.01):
-    height, width = energy_matrix.shape
-    baseline_energy = np.mean(energy_matrix[energy_matrix > 0]) if np.any(energy_matrix > 0) else 0
-    output = np.copy(energy_matrix)
-    
-    for _ in range(steps):
-        new_output = np.copy(output)
-        
-        for y in range(height):
-            for x in range(width):
-                center = output[y, x]
-                cell_type = grid[y][x]
-                neighbors = []
-                neighbor_types = []
-                
-                if y > 0: 
-                    neighbors.append(output[y - 1, x])
-                    neighbor_types.append(grid[y - 1][x])
-                if y < height - 1: 
-                    neighbors.append(output[y + 1, x])
-                    neighbor_types.append(grid[y + 1][x])
-                if x > 0: 
-                    neighbors.append(output[y, x - 1])
-                    neighbor_types.append(grid[y][x - 1])
-                if x < width - 1: 
-                    neighbors.append(output[y, x + 1])
-                    neighbor_types.append(grid[y][x + 1])
-                
-                if neighbors:
-                    # Calculate Laplacian (diffusion term)
-                    laplacian = sum(neighbors) - len(neighbors) * center
-                    
-                    # Apply diffusion equation (same as heat.py)
-                    new_output[y, x] = center + alpha * laplacian - beta * (center - baseline_energy)
-                    
-                    # Green spaces and water have strong cooling effect on neighbors
-                    if cell_type == 'g':  # Green space - cooling source
-                        new_output[y, x] = -baseline_energy * 0.3  # Strong cooling effect
-                    elif cell_type == 'b':  # Water - even stronger cooling
-                        new_output[y, x] = -baseline_energy * 0.5  # Very strong cooling effect
-                    elif cell_type in ['l', 'd']:  # Buildings get cooled by nearby green/water
-                        green_neighbors = neighbor_types.count('g')
-                        water_neighbors = neighbor_types.count('b')
-                        total_neighbors = len(neighbor_types)
-                        
-                        if total_neighbors > 0:
-                            # Additional cooling from nearby green spaces and water
-                            green_cooling = (green_neighbors / total_neighbors) * 0.15 * baseline_energy
-                            water_cooling = (water_neighbors / total_neighbors) * 0.25 * baseline_energy
-                            
-                            new_output[y, x] -= (green_cooling + water_cooling)
-                    
-                    # Ensure reasonable bounds
-                    if cell_type in ['l', 'd'] and new_output[y, x] < 0:
-                        new_output[y, x] = baseline_energy * 0.1  # Minimum energy for buildings
-        
-        output = new_output
-    
-    return output
+def energy_baseline(energy_matrix):
+    return np.mean(energy_matrix[energy_matrix > 0]) if np.any(energy_matrix > 0) else 0
+
+def apply_energy_diffusion(energy_matrix, grid, steps=50, alpha=0.02, beta=0.01, tol=None):
+    return smooth_energy(energy_matrix, grid, steps, alpha, beta, tol)[0]
+
+def smooth_energy(energy_matrix, grid, steps=50, alpha=0.02, beta=0.01, tol=None):
+    # diffuse_energy around the matrix's own baseline, on whichever kernel backend
+    # kernels.py picks for the grid. returns (smoothed, info)
+    from kernels import run
+    return run('energy_diffusion', energy_matrix, steps, as_grid(grid).types, energy_baseline(energy_matrix),
+               alpha, beta, tol=tol)
+
+def diffuse_energy(energy_matrix, grid, baseline_energy, steps=50, alpha=0.02, beta=0.01, tol=None, every=CHECK_EVERY,
+                   region=Ellipsis):
+    # the baseline is a mean over the whole city, so it comes in from outside.
+    # returns (smoothed, info) like relax
+    city = as_grid(grid)
+    housing = city.mask(LIGHT) | city.mask(DENSE)
+    green = city.mask(GREEN)
+    water = city.mask(WATER)
+    housing_cooling, has_neighbors = energy_cooling(city, baseline_energy)
+    diffuse = relaxation_step(city.shape, alpha, beta, baseline_energy)
+
+    def step(output, new_output):
+        # Apply diffusion equation (same as heat.py)
+        diffuse(output, new_output)
+        # Buildings get cooled by nearby green/water
+        new_output -= housing_cooling
+        # Green spaces and water have strong cooling effect on neighbors
+        new_output[green] = -baseline_energy * 0.3
+        new_output[water] = -baseline_energy * 0.5
+        # Ensure reasonable bounds
+        new_output[housing & (new_output < 0)] = baseline_energy * 0.1  # Minimum energy for buildings
+        np.copyto(new_output, output, where=~has_neighbors)
+
+    return relax(step, energy_matrix, steps, tol, every, region)
+
+def energy_cooling(grid, baseline_energy):
+    # (cooling of every housing cell, which cells have a neighbor at all)
+    city = as_grid(grid)
+    housing = city.mask(LIGHT) | city.mask(DENSE)
+    # how many of the 4 neighbors exist, and how many of those are green / water
+    inside = np.ones(city.shape)
+    neighbor_count = neighbor_sum(inside)
+    has_neighbors = neighbor_count > 0
+    safe_count = np.where(has_neighbors, neighbor_count, 1)
+    # Additional cooling from nearby green spaces and water
+    cooling = (neighbor_sum(city.mask(GREEN)) / safe_count) * 0.15 * baseline_energy \
+        + (neighbor_sum(city.mask(WATER)) / safe_count) * 0.25 * baseline_energy
+    return np.where(housing, cooling, 0.0), has_neighbors
+
+def neighbor_sum(plane):
+    # sum over the 4 adjacent cells that exist
+    padded = np.pad(np.asarray(plane, dtype=float), 1)
+    return padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]
 
 def generate_energy_heatmap(energy_matrix, grid=None):
-    height, width = energy_matrix.shape
-    
     if grid is not None:
         smoothed_energy = apply_energy_diffusion(energy_matrix, grid)
     else:
         smoothed_energy = energy_matrix
     
-    max_energy = smoothed_energy.max()
-    min_energy = smoothed_energy.min()
-    
+    return energy_colors(smoothed_energy, smoothed_energy.min(), smoothed_energy.max())
+
+def energy_colors(smoothed_energy, min_energy, max_energy):
     if max_energy > min_energy:
         normalized_energy = ((smoothed_energy - min_energy) / (max_energy - min_energy)) * 255
     else:
         normalized_energy = np.full_like(smoothed_energy, 127)  # Mid-range if all same
     
-    fig = plt.figure(figsize=(width / 100, height / 100), dpi=100)
-    ax = fig.add_axes([0, 0, 1, 1])
-    
-    im = ax.imshow(normalized_energy, cmap='magma', interpolation='nearest', vmin=0, vmax=255)
-    ax.axis('off')
-    
-    canvas = FigureCanvas(fig)
-    canvas.draw()
-    
-    image_array = np.frombuffer(canvas.tostring_argb(), dtype=np.uint8)
-    image_array = image_array.reshape((height, width, 4))
-    
-    rgb_pixels = [[[int(pixel[1]), int(pixel[2]), int(pixel[3])] for pixel in row] for row in image_array]
-    
-    plt.close(fig)
-    return rgb_pixels
+    return colorize(normalized_energy, 'magma', vmin=0, vmax=255)
 
-def simulate_energy_distribution(grid, steps=50):
-    height = len(grid)
-    width = len(grid[0])
+def simulate_energy_distribution(grid, steps=50, tol=None):
+    city = as_grid(grid)
+    height, width = city.shape
     
     energy_values = {
         'l': 15.0,
@@ -213,33 +182,22 @@ def simulate_energy_distribution(grid, steps=50):
         'e': 0.0
     }
     
-    energy_dist = np.zeros((height, width), dtype=float)
-    
-    for y in range(height):
-        for x in range(width):
-            cell_type = grid[y][x]
-            energy_dist[y, x] = energy_values.get(cell_type, 0.0)
+    energy_dist = np.array([energy_values.get(name, 0.0) for name in TYPES])[city.types]
     
     alpha = 0.05  
-    
-    for _ in range(steps):
-        new_energy_dist = np.copy(energy_dist)
-        
-        for y in range(height):
-            for x in range(width):
-                center = energy_dist[y, x]
-                neighbors = []
-                
-                if y > 0: neighbors.append(energy_dist[y - 1, x])
-                if y < height - 1: neighbors.append(energy_dist[y + 1, x])
-                if x > 0: neighbors.append(energy_dist[y, x - 1])
-                if x < width - 1: neighbors.append(energy_dist[y, x + 1])
-                
-                if neighbors:
-                    avg_neighbor = sum(neighbors) / len(neighbors)
-                    new_energy_dist[y, x] = center + alpha * (avg_neighbor - center) * 0.1
-        
-        energy_dist = new_energy_dist
+    neighbor_count = neighbor_sum(np.ones((height, width)))
+    has_neighbors = neighbor_count > 0
+    safe_count = np.where(has_neighbors, neighbor_count, 1)
+    laplacian = EdgeLaplacian(city.shape)
+    
+    def step(energy_dist, out):
+        # avg_neighbor - center is the laplacian over the neighbor count
+        np.multiply(alpha, laplacian(energy_dist) / safe_count, out=out)
+        out *= 0.1
+        out += energy_dist
+        np.copyto(out, energy_dist, where=~has_neighbors)
+
+    energy_dist, info = relax(step, energy_dist, steps, tol)
     
     distributed_heatmap = generate_energy_heatmap(energy_dist)
     
@@ -247,7 +205,9 @@ def simulate_energy_distribution(grid, steps=50):
         'max_energy_load': float(energy_dist.max()),
         'avg_energy_load': float(energy_dist.mean()),
         'energy_variance': float(energy_dist.var()),
-        'grid_efficiency': float(1.0 / (energy_dist.var() + 1.0)) 
+        'grid_efficiency': float(1.0 / (energy_dist.var() + 1.0)),
+        'steps': info['steps'],
+        'residual': info['residual']
     }
     
     return distributed_heatmap, distribution_stats
@@ -0,0 +1,142 @@
+import argparse
+import copy
+import math
+import time
+import torch
+from torch import nn
+from model import unet
+from demo import device, sample_batch
+from scheduler import sampler_state
+
+# every conv in the unet feeds relu then batchnorm: bn(relu(conv(x))). with
+# a = gamma / sqrt(var + eps) per channel, a * relu(z) == sign(a) * relu(|a| * z),
+# so |a| goes into the conv weights and only a sign flip plus shift is left
+FOLDS = [('dconv11', 'bnorm12'), ('dconv12', 'bnorm1'), ('dconv21', 'bnorm22'), ('dconv22', 'bnorm2'),
+         ('dconv31', 'bnorm32'), ('dconv32', 'bnorm3'), ('dconv41', 'bnorm42'), ('dconv42', 'bnorm4'),
+         ('trans1', 'bnorm52'), ('trans2', 'bnorm5'),
+         ('uconv11', 'bnormu12'), ('uconv12', 'bnormu1'), ('uconv21', 'bnormu22'), ('uconv22', 'bnormu2'),
+         ('uconv31', 'bnormu32'), ('uconv32', 'bnormu3'), ('uconv41', 'bnormu42'), ('uconv42', 'bnormu4')]
+
+DTYPES = ('fp32', 'bf16', 'int8')
+
+class ChannelAffine(nn.Module):
+    # what is left of a batchnorm after its scale moved into the conv
+    def __init__(self, sign, shift):
+        super().__init__()
+        self.flip = bool((sign < 0).any())
+        self.register_buffer('sign', sign.view(1, -1, 1, 1))
+        self.register_buffer('shift', shift.view(1, -1, 1, 1))
+
+    def forward(self, x):
+        if self.flip:
+            x = x * self.sign
+        return x + self.shift
+
+class CastBF16(nn.Module):
+    # fp32 in and out, convs and linears in bf16 under autocast
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, timestep):
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16):
+            out = self.model(x, timestep)
+        return out.float()
+
+@torch.no_grad()
+def fold_batchnorm(model):
+    folded = copy.deepcopy(model).eval()
+    for conv_name, bn_name in FOLDS:
+        conv, bn = getattr(folded, conv_name), getattr(folded, bn_name)
+        a = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        conv.weight.mul_(a.abs().view(-1, 1, 1, 1))
+        conv.bias.mul_(a.abs())
+        setattr(folded, bn_name, ChannelAffine(torch.sign(a), bn.bias - a * bn.running_mean))
+    return folded
+
+@torch.no_grad()
+def calibrate(model, grids, steps):
+    # int8 ranges from the inputs the sampler really produces
+    for k, grid in enumerate(grids):
+        sample_batch(model, [grid], steps=steps, seeds=[k], show_progress=False)
+
+def export(model, dtype='fp32', img_size=128, calibration=None, steps=20):
+    # folded, optionally quantized or bf16, traced and frozen torchscript module
+    model = fold_batchnorm(model)
+    if dtype == 'int8':
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        example = (torch.randn(1, 3, img_size, img_size), torch.zeros(1, dtype=torch.long))
+        # the timestep embedding takes integer timesteps and stays in float
+        qconfig = get_default_qconfig_mapping('x86').set_module_name('time_embedder', None)
+        model = prepare_fx(model, qconfig, example)
+        calibrate(model, calibration or [], steps)
+        model = convert_fx(model)
+    elif dtype == 'bf16':
+        model = CastBF16(model)
+    example = (torch.randn(1, 3, img_size, img_size, device=device), torch.zeros(1, dtype=torch.long, device=device))
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example, check_trace=False)
+        return torch.jit.freeze(traced)
+
+@torch.no_grad()
+def compare(reference, candidate, grids, steps, seeds):
+    # same grids, seeds and sampler through both models, in 0-255 pixel units
+    ref = sample_batch(reference, grids, steps=steps, seeds=seeds, show_progress=False)
+    out = sample_batch(candidate, grids, steps=steps, seeds=seeds, show_progress=False)
+    diffs = [abs(a.astype(float) - b.astype(float)) for a, b in zip(ref, out)]
+    mse = sum((d ** 2).mean() for d in diffs) / len(diffs)
+    return {'mean_abs': float(sum(d.mean() for d in diffs) / len(diffs)),
+            'max_abs': float(max(d.max() for d in diffs)),
+            'psnr': float('inf') if mse == 0 else 10 * math.log10(255.0 ** 2 / mse)}
+
+@torch.no_grad()
+def step_latency(model, batch_size=1, img_size=128, repeats=10):
+    # seconds per unet forward, i.e. per sampler step
+    x = torch.randn(batch_size, 3, img_size, img_size, device=device)
+    t = sampler_state(device).t_batch(500, batch_size)
+    for _ in range(2):
+        model(x, t)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model(x, t)
+    return (time.perf_counter() - start) / repeats
+
+def save_artifact(module, path, dtype):
+    torch.jit.save(module, path, _extra_files={'dtype': dtype})
+
+def load_artifact(path):
+    # optimize_for_inference's onednn graphs do not survive a save, so fp32
+    # artifacts get that pass here on every load instead
+    extra = {'dtype': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra).eval()
+    if extra['dtype'] in ('fp32', b'fp32') and device == 'cpu':
+        module = torch.jit.optimize_for_inference(module)
+    return module
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the unet as a folded torchscript artifact, check it against fp32 and time it")
+    parser.add_argument("--dtype", choices=DTYPES, default='fp32')
+    parser.add_argument("--out", default=None, help="artifact path (default unet-<dtype>.pt)")
+    parser.add_argument("--weights", default="model.pth")
+    parser.add_argument("--steps", type=int, default=50, help="ddim steps for the quality check")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--batch", type=int, default=1, help="batch size for the latency benchmark")
+    args = parser.parse_args()
+
+    reference = unet().to(device)
+    reference.load_state_dict(torch.load(args.weights, map_location=device))
+    reference.eval()
+    grids = [[['ldbg'[(i * (k + 1) + j) % 4] for j in range(16)] for i in range(16)] for k in range(len(args.seeds))]
+
+    start = time.perf_counter()
+    artifact = export(reference, args.dtype, calibration=grids)
+    out = args.out or f"unet-{args.dtype}.pt"
+    save_artifact(artifact, out, args.dtype)
+    print(f"wrote {out} in {time.perf_counter() - start:.1f} s")
+
+    folded = compare(reference, fold_batchnorm(reference), grids, args.steps, args.seeds)
+    print("folded eager vs fp32:", folded)
+    print(f"{args.dtype} artifact vs fp32:", compare(reference, load_artifact(out), grids, args.steps, args.seeds))
+    for name, model in (('eager fp32', reference), (f'{args.dtype} artifact', load_artifact(out))):
+        print(f"{name:>16}: {step_latency(model, args.batch) * 1000:8.1f} ms/step at batch {args.batch}")
@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+def timed(fn, kwargs):
+    start = time.perf_counter()
+    result = fn(**kwargs)
+    return result, time.perf_counter() - start
+
+def run_graph(tasks, pool, on_done=None):
+    # tasks maps name -> (fn, [dependency names]). fn gets each dependency's result
+    # as a keyword argument and is submitted to the pool as soon as they all exist.
+    # a fn may return a Future for work it handed to another executor (the sample
+    # batcher); the task's result is then what that resolves to, and no pool
+    # thread sits waiting for it. on_done(name, result) runs on the calling
+    # thread as each task finishes. returns ({name: result}, {name: seconds})
+    results, timings = {}, {}
+    remaining = dict(tasks)
+    running = {}
+    # handed off futures -> (name, seconds on the pool, when they were handed off)
+    waiting = {}
+    try:
+        while remaining or running or waiting:
+            for name in [n for n, (_, deps) in remaining.items() if all(d in results for d in deps)]:
+                fn, deps = remaining.pop(name)
+                running[pool.submit(timed, fn, {d: results[d] for d in deps})] = name
+            if not running and not waiting:
+                raise ValueError("unsatisfiable dependencies: " + ", ".join(sorted(remaining)))
+            done, _ = wait(list(running) + list(waiting), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in running:
+                    name = running.pop(future)
+                    result, seconds = future.result()
+                    if isinstance(result, Future):
+                        waiting[result] = (name, seconds, time.perf_counter())
+                        continue
+                else:
+                    name, seconds, handed = waiting.pop(future)
+                    result, seconds = future.result(), seconds + time.perf_counter() - handed
+                results[name], timings[name] = result, seconds
+                if on_done is not None:
+                    on_done(name, results[name])
+    finally:
+        for future in list(running) + list(waiting):
+            future.cancel()
+    return results, timings
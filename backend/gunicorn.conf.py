@@ -0,0 +1,31 @@
+import os
+
+# gunicorn -c gunicorn.conf.py backend:app
+# the app is imported once in the master (preload), so the unet weights are
+# loaded once and shared copy-on-write by the forked workers. each worker runs
+# WEB_THREADS requests at a time and warms itself up after the fork.
+# jobs, their events and incremental bases live in the worker that made them,
+# so with more than one worker put the api behind sticky sessions
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+preload_app = True
+workers = int(os.environ.get("WEB_WORKERS", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 8))
+# a full 1000 step diffusion on cpu takes minutes
+timeout = int(os.environ.get("WEB_TIMEOUT", 600))
+graceful_timeout = 30
+keepalive = 5
+
+# split the cores between the workers instead of every worker asking for all of them
+os.environ.setdefault("TORCH_THREADS", str(max(1, (os.cpu_count() or 2) // workers)))
+
+def when_ready(server):
+    # runs in the master after the app import and before any fork, so the
+    # weights get loaded exactly once
+    import backend
+    backend.load_model()
+
+def post_fork(server, worker):
+    import backend
+    backend.readiness.start()
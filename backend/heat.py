@@ -1,6 +1,7 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from colormap import colorize
+from citygrid import TYPES, as_grid
+from relax import relax, relaxation_step, CHECK_EVERY
 
 test = [
    ['d','d','d','d','d','g','g','b','d','d'],
@@ -17,56 +18,65 @@ test = [
 
 trans = {'l': 1, 'd': 1.5, 'b': -1.5, 'g': -1}
 
-def simheat(grid, airtemp, steps=75, alpha=0.01, beta = 0.01, hot = True): 
-    height = len(grid)
-    width = len(grid[0])
-    
-    trans = {'l': 1.0, 'd': 1.5, 'b': -1.5, 'g': -1.0}
-    
-    output = np.full((height, width), airtemp, dtype=float)
-    for y in range(height):
-        for x in range(width):
-            output[y, x] += trans.get(grid[y][x], 0)
+def laplacian(field):
+    # edge padding makes missing neighbors equal the center so they add 0,
+    # same as only summing the neighbors that exist
+    padded = np.pad(field, 1, mode='edge')
+    return (padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]
+            - 4 * field)
 
-    for _ in range(steps):
-        new_output = np.copy(output)
-        for y in range(height):
-            for x in range(width):
-                center = output[y, x]
-                neighbors = []
-                if y > 0: neighbors.append(output[y - 1, x])
-                if y < height - 1: neighbors.append(output[y + 1, x])
-                if x > 0: neighbors.append(output[y, x - 1])
-                if x < width - 1: neighbors.append(output[y, x + 1])
-                
-                laplacian = sum(neighbors) - len(neighbors) * center
+def steady_heat(source, airtemp, alpha=0.01, beta=0.01):
+    # solves alpha*lap(u) - beta*(u - airtemp - source) = 0 in one go
+    # tiles keep pushing their offset instead of it decaying away
+    from scipy.sparse import diags, identity, kron
+    from scipy.sparse.linalg import spsolve
+    height, width = source.shape
 
-                new_output[y, x] = center + alpha * laplacian - beta * (center - airtemp)
-        output = new_output
+    def path(n):
+        # 1d graph laplacian, ends only have one neighbor
+        deg = np.full(n, 2.0)
+        deg[0] = deg[-1] = 1.0 if n > 1 else 0.0
+        return diags([np.ones(n - 1), -deg, np.ones(n - 1)], [-1, 0, 1])
+
+    lap = kron(identity(height), path(width)) + kron(path(height), identity(width))
+    system = (beta * identity(height * width) - alpha * lap).tocsc()
+    rhs = beta * (airtemp + source).ravel()
+    return spsolve(system, rhs).reshape(height, width)
+
+# heat offset per type code
+SOURCE = np.array([{'l': 1.0, 'd': 1.5, 'b': -1.5, 'g': -1.0}.get(name, 0) for name in TYPES], dtype=float)
+
+def source_field(grid):
+    return SOURCE[as_grid(grid).types]
+
+def render_heat(output, airtemp, hot=True):
+    # (image, (max, min), field) like simheat returns, from a finished field
     tempoutput = output
     maxtemp = output.max()
     mintemp = output.min()
-    difarray = np.full((height, width), airtemp, dtype=float)
-    output = output - difarray
+    output = output - airtemp
     output = output * 125 + 125
-    fig, ax = plt.subplots()
-    height, width = output.shape
-    fig = plt.figure(figsize=(width / 100, height / 100), dpi=100)
-    ax = fig.add_axes([0, 0, 1, 1]) 
-    
     # add here
-    if hot:
-        ax.imshow(output, cmap='inferno', interpolation='nearest', vmin=0, vmax=255)
+    image = colorize(output, 'inferno' if hot else 'Blues_r', vmin=0, vmax=255)
+    return (image,(float(maxtemp),float(mintemp)),tempoutput)
+
+def heat_steps(output, airtemp, steps=75, alpha=0.01, beta=0.01, tol=None, every=CHECK_EVERY, region=Ellipsis):
+    # the explicit update from a given field, at most steps times or until no
+    # cell moves by tol in a step. returns (field, info) like relax
+    step = relaxation_step(np.shape(output), alpha, beta, airtemp)
+    return relax(step, output, steps, tol, every, region)
+
+def simheat(grid, airtemp, steps=75, alpha=0.01, beta = 0.01, hot = True, steady = False, tol = None): 
+    # (image, (max, min), field, info), info is how many steps ran and the last residual
+    source = source_field(grid)
+
+    if steady:
+        output = steady_heat(source, airtemp, alpha, beta)
+        info = {'steps': 0, 'residual': 0.0, 'converged': True}
     else:
-        ax.imshow(output, cmap='Blues_r', interpolation='nearest', vmin=0, vmax=255)
-    ax.axis('off') 
-    canvas = FigureCanvas(fig)
-    canvas.draw()
-    image = np.frombuffer(canvas.tostring_argb(), dtype=np.uint8).reshape((height, width, 4))
-    # Convert to JSON serializable format
-    rgb_pixels = [[[int(pixel[1]), int(pixel[2]), int(pixel[3])] for pixel in row] for row in image]
-    plt.close(fig)
-    return (rgb_pixels,(float(maxtemp),float(mintemp)),tempoutput)
+        from kernels import run
+        output, info = run('heat', airtemp + source, steps, airtemp, alpha, beta, tol=tol)
+    return render_heat(output, airtemp, hot) + (info,)
 #result = simheat(test, airtemp=5,hot = False)
 #print( result[1])
 #plt.imshow(result)
@@ -0,0 +1,144 @@
+import numpy as np
+from heat import source_field
+from energy import energy_matrix
+from waste import COEFFS, waste_field, waste_steps
+from kernels import EXACT_MODE
+from tiles import HALO
+from relax import relax
+from citygrid import TYPES
+
+# what the builder sends: the type codes plus 'e', empty land
+KNOWN_TYPES = frozenset(TYPES) | {'e'}
+
+# boxes are (y0, y1, x0, x1), half open like slices
+
+def bbox(cells):
+    rows = [r for r, _ in cells]
+    cols = [c for _, c in cells]
+    return (min(rows), max(rows) + 1, min(cols), max(cols) + 1)
+
+def grow(box, r, shape):
+    y0, y1, x0, x1 = box
+    return (max(y0 - r, 0), min(y1 + r, shape[0]), max(x0 - r, 0), min(x1 + r, shape[1]))
+
+def window(box):
+    return (slice(box[0], box[1]), slice(box[2], box[3]))
+
+def inner(box, outer):
+    # box expressed relative to the enclosing box
+    return window((box[0] - outer[0], box[1] - outer[0], box[2] - outer[2], box[3] - outer[2]))
+
+def apply_changes(grid, changes):
+    # changes are {"row", "col", "type"}; returns the new grid and the cells that really changed.
+    # all of them are checked first: a negative index would wrap and give bbox a -1,
+    # so a bad edit is a ValueError (a 400 from the route) before anything moves
+    rows, cols = len(grid), len(grid[0]) if grid else 0
+    edits = []
+    for change in changes:
+        r, c = int(change['row']), int(change['col'])
+        if not (0 <= r < rows and 0 <= c < cols):
+            raise ValueError(f"change at ({r}, {c}) is outside the {rows}x{cols} grid")
+        if change['type'] not in KNOWN_TYPES:
+            raise ValueError(f"unknown cell type {change['type']!r}")
+        edits.append((r, c, change['type']))
+    new_grid = [list(row) for row in grid]
+    cells = []
+    for r, c, kind in edits:
+        if new_grid[r][c] != kind:
+            new_grid[r][c] = kind
+            cells.append((r, c))
+    return new_grid, cells
+
+def update_energy(matrix, grid, cells):
+    # a 5x5 rule only reaches 2 cells, so recompute that ring around the edits
+    # from a slice with 2 more cells of context and paste it back
+    shape = matrix.shape
+    affected = grow(bbox(cells), 2, shape)
+    context = grow(affected, 2, shape)
+    sub = energy_matrix([row[context[2]:context[3]] for row in grid[context[0]:context[1]]])
+    out = matrix.copy()
+    out[window(affected)] = sub[inner(affected, context)]
+    return out
+
+def heat_delta(delta_source, box, shape, steps, alpha, beta):
+    # the heat update is linear in (field - airtemp), so an edit only adds
+    # steps applications of the stencil to its source change. run that on the
+    # window through relax: real grid edges keep edge padding, the window's own
+    # edges are held at zero change. returns (delta, open edges, relax info)
+    open_edges = (box[0] > 0, box[1] < shape[0], box[2] > 0, box[3] < shape[1])
+
+    def step(src, dst):
+        padded = np.pad(src, 1, mode='edge')
+        if open_edges[0]: padded[0, :] = 0
+        if open_edges[1]: padded[-1, :] = 0
+        if open_edges[2]: padded[:, 0] = 0
+        if open_edges[3]: padded[:, -1] = 0
+        lap = padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:] - 4 * src
+        dst[...] = src + alpha * lap - beta * src
+    d, info = relax(step, delta_source[window(box)], steps)
+    return d, open_edges, info
+
+def update_heat(field, old_grid, new_grid, cells, steps=75, alpha=0.01, beta=0.01, tol=1e-6, radius=8):
+    # grows the window until the change on its open edges is below tol.
+    # returns (field, window, rim residual, relax info of the delta)
+    shape = field.shape
+    delta_source = np.zeros(shape)
+    for r, c in cells:
+        delta_source[r, c] = source_field([[new_grid[r][c]]])[0, 0] - source_field([[old_grid[r][c]]])[0, 0]
+    while True:
+        box = grow(bbox(cells), radius, shape)
+        d, open_edges, info = heat_delta(delta_source, box, shape, steps, alpha, beta)
+        rim = [d[0, :] if open_edges[0] else None, d[-1, :] if open_edges[1] else None,
+               d[:, 0] if open_edges[2] else None, d[:, -1] if open_edges[3] else None]
+        residual = max((np.abs(edge).max() for edge in rim if edge is not None), default=0.0)
+        if residual < tol or not any(open_edges):
+            break
+        radius *= 2
+    out = field.copy()
+    out[window(box)] += d
+    return out, box, residual, info
+
+def update_waste(waste, new_grid, temp, dirty, steps=10, coeffs=COEFFS):
+    # rules 1 and 7 compare deltas, so a step reaches HALO['waste'] cells (see
+    # tiles.py): only cells that far per step from the dirty box can change, and
+    # those only read cells that far from themselves. in exact mode the list
+    # order lets a delta chain along a whole row in one step, so it all reruns.
+    # returns (field, info of the run over the window)
+    if EXACT_MODE:
+        return waste_steps(new_grid, temp, steps, coeffs)
+    shape = waste.shape
+    reach = HALO['waste'] * steps
+    affected = grow(dirty, reach, shape)
+    context = grow(affected, reach, shape)
+    sub, info = waste_steps([row[context[2]:context[3]] for row in new_grid[context[0]:context[1]]],
+                            temp[window(context)], steps, coeffs)
+    out = waste.copy()
+    out[window(affected)] = sub[inner(affected, context)]
+    return out, info
+
+def check(size=40, trials=50, steps=10, coeffs=COEFFS, airtemp=25.0, seed=0):
+    # largest difference between update_waste after one edited cell and a full
+    # waste_field of the edited layout. the heat field stays put and the dirty
+    # box is just the cell, so only the waste window is under test
+    from heat import simheat
+    rng = np.random.default_rng(seed)
+    worst = 0.0
+    for _ in range(trials):
+        grid = rng.choice(list('dlgbe'), (size, size)).tolist()
+        heat = simheat(grid, airtemp)[2]
+        waste = waste_field(grid, heat, steps, coeffs)
+        r, c = (int(v) for v in rng.integers(0, size, 2))
+        new_grid, cells = apply_changes(grid, [{'row': r, 'col': c, 'type': str(rng.choice(list('dlgbe')))}])
+        if not cells:
+            continue
+        got = update_waste(waste, new_grid, heat, bbox(cells), steps, coeffs)[0]
+        worst = max(worst, float(np.abs(got - waste_field(new_grid, heat, steps, coeffs)).max()))
+    return worst
+
+if __name__ == '__main__':
+    # python incremental.py: update_waste against a full rerun. short runs with
+    # hot, large coefficients are where rules 1 and 7 carry an edit furthest
+    boosted = dict(COEFFS, overflow=0.3, lighttrashspread=0.2, litter=0.2, housingrunoff=0.2)
+    for steps in (1, 3, 10):
+        print(f"{steps:2d} steps: default {check(steps=steps):.1e}, "
+              f"rules 1 and 7 firing {check(steps=steps, coeffs=boosted, airtemp=300.0):.1e}")
@@ -0,0 +1,92 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class Job:
+    # one evaluation run. events are kept so a late subscriber still sees everything
+    def __init__(self, data):
+        self.id = uuid.uuid4().hex
+        self.data = data
+        self.status = 'queued'
+        self.created = time.time()
+        self.result = {}
+        self.stages = []
+        self.progress = None
+        self.events = []
+        self.cond = threading.Condition()
+
+    def emit(self, event, payload=None):
+        with self.cond:
+            if event == 'stage':
+                self.stages.append(payload['stage'])
+                self.result.update(payload['result'])
+            elif event == 'progress':
+                self.progress = payload
+            elif event in ('done', 'error'):
+                self.status = event
+            self.events.append((event, payload))
+            self.cond.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'error')
+
+    def stream(self, keepalive=15):
+        # yields (event, payload) in order, None while idle so the caller can ping
+        index = 0
+        while True:
+            with self.cond:
+                if index >= len(self.events):
+                    self.cond.wait(timeout=keepalive)
+                pending = self.events[index:]
+                index += len(pending)
+            if not pending:
+                yield None
+            for event, payload in pending:
+                yield event, payload
+                if event in ('done', 'error'):
+                    return
+
+class JobManager:
+    # runner(data, report, progress) does the work, report(stage, partial) hands
+    # back each finished stage and progress(step, total) the diffusion steps
+    def __init__(self, runner, max_workers=2, max_pending=32, history=100):
+        self.runner = runner
+        self.max_pending = max_pending
+        self.history = history
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+
+    def pending(self):
+        return sum(1 for job in self.jobs.values() if not job.finished)
+
+    def submit(self, data):
+        # None when the queue is full
+        with self.lock:
+            if self.pending() >= self.max_pending:
+                return None
+            job = Job(data)
+            self.jobs[job.id] = job
+            # forget the oldest finished jobs past the history limit
+            for old_id in [k for k, old in self.jobs.items() if old.finished][:max(0, len(self.jobs) - self.history)]:
+                del self.jobs[old_id]
+        self.executor.submit(self.run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def run(self, job):
+        job.status = 'running'
+        try:
+            self.runner(job.data,
+                        lambda stage, partial: job.emit('stage', {'stage': stage, 'result': partial}),
+                        lambda step, total: job.emit('progress', {'step': step, 'total': total}))
+            job.emit('done')
+        except Exception as e:
+            print("Error processing job", job.id, str(e))
+            job.emit('error', {'error': 'Invalid request'})
@@ -0,0 +1,358 @@
+import importlib.util
+import os
+import sys
+import threading
+import time
+import numpy as np
+from citygrid import TYPES, DENSE, LIGHT, GREEN, WATER
+from relax import CHECK_EVERY
+from heat import SOURCE, heat_steps
+from waste import COEFFS, ca_step, ca_steps, wastemaker
+from energy import energy_matrix, energy_baseline, energy_cooling, diffuse_energy
+
+# heat, waste and the energy smoothing, each on one of several backends:
+#   python  plain loops over the cells in the order the list code used, the
+#           reference the others are checked against. waste runs ca_step itself
+#   numba   the same loops compiled, so bit for bit the reference. that includes
+#           waste rules 1 and 7 reading delta while it is still being added up
+#   numpy   the array code, bit for bit the reference for heat and energy. its
+#           waste rules 1 and 7 see the whole delta of the rules before them
+#   torch   stack.py's kernels on a (1, H, W) stack, on SIM_DEVICE (cuda if there
+#           is one). float64 on the cpu, float32 on a gpu
+# every kernel is run(kernel, field, steps, *params) and returns (field, info)
+# like relax.relax, params being
+#   heat              airtemp, alpha, beta
+#   waste             types, coeffs
+#   energy_diffusion  types, baseline, alpha, beta
+KERNELS = ('heat', 'waste', 'energy_diffusion')
+EXACT = {'heat': ('python', 'numba', 'numpy'), 'waste': ('python', 'numba'),
+         'energy_diffusion': ('python', 'numba', 'numpy')}
+
+# SIM_BACKEND=numba runs every kernel on numba, SIM_BACKEND=waste:numba,heat:torch
+# picks per kernel, anything not named is chosen by size. SIM_EXACT=1 picks only
+# backends with the reference results, which for waste means the rule 1 and 7
+# order of the list code instead of numpy's. the app's results so far are numpy's
+def parse_backends(text):
+    names = {}
+    for part in filter(None, (p.strip() for p in text.split(','))):
+        kernel, _, name = part.rpartition(':')
+        names[kernel or '*'] = name
+    return names
+
+OVERRIDE = parse_backends(os.environ.get("SIM_BACKEND", ""))
+EXACT_MODE = os.environ.get("SIM_EXACT", "") not in ("", "0")
+
+# (largest grid in cells, backends in order of preference) from python kernels.py.
+# compiled, numba is 3-10x numpy at every size, but the first use compiles for a
+# second or two and a run under 32x32 is a couple of ms on numpy anyway. torch
+# on the cpu loses to numpy everywhere. waste stays numpy outside exact mode so
+# the results don't change with the grid size
+AUTO = {
+    'heat': [(32 * 32, ('numpy',)), (None, ('numba', 'numpy'))],
+    'waste': [(None, ('numpy',))],
+    'energy_diffusion': [(32 * 32, ('numpy',)), (None, ('numba', 'numpy'))],
+}
+AUTO_EXACT = {'waste': [(None, ('numba', 'python'))]}
+
+def available(name):
+    return name in ('python', 'numpy') or importlib.util.find_spec(name) is not None
+
+# the loops. numba compiles them on first use, as plain python they are the reference
+
+def heat_loop(field, steps, airtemp, alpha, beta):
+    height, width = field.shape
+    src = field.copy()
+    dst = np.empty_like(src)
+    for _ in range(steps):
+        for i in range(height):
+            for j in range(width):
+                c = src[i, j]
+                up = src[i - 1, j] if i > 0 else c
+                down = src[i + 1, j] if i < height - 1 else c
+                left = src[i, j - 1] if j > 0 else c
+                right = src[i, j + 1] if j < width - 1 else c
+                lap = up + down + left + right - c * 4
+                dst[i, j] = c + lap * alpha - (c - airtemp) * beta
+        src, dst = dst, src
+    return src
+
+def energy_loop(field, steps, types, cooling, has_neighbors, baseline, alpha, beta):
+    height, width = field.shape
+    src = field.copy()
+    dst = np.empty_like(src)
+    for _ in range(steps):
+        for i in range(height):
+            for j in range(width):
+                c = src[i, j]
+                if not has_neighbors[i, j]:
+                    dst[i, j] = c
+                    continue
+                up = src[i - 1, j] if i > 0 else c
+                down = src[i + 1, j] if i < height - 1 else c
+                left = src[i, j - 1] if j > 0 else c
+                right = src[i, j + 1] if j < width - 1 else c
+                lap = up + down + left + right - c * 4
+                new = c + lap * alpha - (c - baseline) * beta - cooling[i, j]
+                t = types[i, j]
+                if t == GREEN:
+                    new = -baseline * 0.3
+                elif t == WATER:
+                    new = -baseline * 0.5
+                elif (t == LIGHT or t == DENSE) and new < 0:
+                    new = baseline * 0.1
+                dst[i, j] = new
+        src, dst = dst, src
+    return src
+
+def waste_loop(field, steps, types, overflow, runoff, litter, green_runoff, buildup, water_diffusion, light_spread,
+               land_diffusion):
+    # ca_step rule for rule, on type codes. neighbors in waste.neumannNeighbors order
+    height, width = field.shape
+    w = field.copy()
+    delta = np.empty_like(w)
+    for _ in range(steps):
+        delta[:] = 0.0
+        for i in range(height):
+            for j in range(width):
+                t = types[i, j]
+                housing = t == DENSE or t == LIGHT
+                initial = w[i, j]
+                for k in range(4):
+                    ni = i - 1 if k == 0 else i + 1 if k == 1 else i
+                    nj = j - 1 if k == 2 else j + 1 if k == 3 else j
+                    if not (0 <= ni < height and 0 <= nj < width):
+                        continue
+                    n = types[ni, nj]
+                    if t == DENSE and n == LIGHT and delta[i, j] >= 100 + delta[ni, nj]:
+                        diff = initial - w[ni, nj]
+                        if diff > 0:
+                            delta[i, j] -= diff * overflow
+                            delta[ni, nj] += diff * overflow
+                    if housing and n == WATER:
+                        delta[i, j] -= initial * runoff
+                        delta[ni, nj] += initial * runoff
+                    if housing and n == GREEN:
+                        delta[i, j] -= initial * litter
+                        delta[ni, nj] += initial * litter
+                    if t == GREEN and n == WATER:
+                        delta[i, j] -= initial * green_runoff
+                        delta[ni, nj] += initial * green_runoff
+                    if t == WATER and (n == GREEN or n == LIGHT or n == DENSE):
+                        delta[i, j] -= initial * buildup
+                        delta[ni, nj] += initial * buildup
+                    if t == WATER and n == WATER:
+                        delta[i, j] -= initial * water_diffusion
+                        delta[ni, nj] += initial * water_diffusion
+                    if t == LIGHT and n == LIGHT and delta[i, j] >= 50 + delta[ni, nj]:
+                        delta[i, j] -= initial * light_spread
+                        delta[ni, nj] += initial * light_spread
+                    if t == GREEN and n == GREEN:
+                        delta[i, j] -= initial * land_diffusion
+                        delta[ni, nj] += initial * land_diffusion
+        w = w + delta
+    return w
+
+WASTE_RATES = ('overflow', 'housingrunoff', 'litter', 'greenspacerunoff', 'watertrashbuildup', 'waterdiffusion',
+               'lighttrashspread', 'landdiffusion')
+_compiled = {}
+
+def compiled(loop):
+    if loop not in _compiled:
+        from numba import njit
+        _compiled[loop] = njit(cache=True)(loop)
+    return _compiled[loop]
+
+# a backend takes the kernel's params and returns advance(field, n), which runs
+# n steps from field and returns the new one without touching field
+
+def heat_python(airtemp, alpha, beta, loop=heat_loop):
+    airtemp, alpha, beta = float(airtemp), float(alpha), float(beta)
+    return lambda field, n: loop(field, n, airtemp, alpha, beta)
+
+def heat_numba(airtemp, alpha, beta):
+    return heat_python(airtemp, alpha, beta, compiled(heat_loop))
+
+def heat_torch(airtemp, alpha, beta):
+    from stack import heat_steps_stack
+    return stacked(lambda field, n: heat_steps_stack(field, airtemp, n, alpha, beta))
+
+def waste_python(types, coeffs):
+    grid = [[TYPES[code] for code in row] for row in types.tolist()]
+
+    def advance(field, n):
+        w = field.tolist()
+        for _ in range(n):
+            w = ca_step(grid, w, coeffs)
+        return np.array(w, dtype=float)
+    return advance
+
+def waste_numba(types, coeffs):
+    loop, rates = compiled(waste_loop), [float(coeffs[k]) for k in WASTE_RATES]
+    return lambda field, n: loop(field, n, types, *rates)
+
+def waste_torch(types, coeffs):
+    from stack import waste_steps_stack
+    return stacked(lambda field, n, types: waste_steps_stack(types, field, n, coeffs), types)
+
+def energy_python(types, baseline, alpha, beta, loop=energy_loop):
+    cooling, has_neighbors = energy_cooling(types, baseline)
+    baseline, alpha, beta = float(baseline), float(alpha), float(beta)
+    return lambda field, n: loop(field, n, types, cooling, has_neighbors, baseline, alpha, beta)
+
+def energy_numba(types, baseline, alpha, beta):
+    return energy_python(types, baseline, alpha, beta, compiled(energy_loop))
+
+def energy_torch(types, baseline, alpha, beta):
+    from stack import energy_diffusion_stack
+    return stacked(lambda field, n, types: energy_diffusion_stack(field, types, n, alpha, beta, baseline), types)
+
+def stacked(fn, types=None):
+    # a stack.py kernel on a one layout stack, the field staying on the device between calls
+    import torch
+    from stack import to_numpy
+    device = os.environ.get("SIM_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.float64 if torch.device(device).type == 'cpu' else torch.float32
+    extra = () if types is None else (torch.as_tensor(types[None], device=device),)
+
+    def advance(field, n):
+        on_device = torch.as_tensor(field[None], dtype=dtype, device=device)
+        return np.asarray(to_numpy(fn(on_device, n, *extra)[0]), dtype=float)
+    return advance
+
+BACKENDS = {
+    'heat': {'python': heat_python, 'numba': heat_numba, 'torch': heat_torch},
+    'waste': {'python': waste_python, 'numba': waste_numba, 'torch': waste_torch},
+    'energy_diffusion': {'python': energy_python, 'numba': energy_numba, 'torch': energy_torch},
+}
+
+# numpy runs its own loop through relax.relax, tol and all
+NUMPY = {
+    'heat': lambda field, steps, airtemp, alpha, beta, tol, every:
+        heat_steps(field, airtemp, steps, alpha, beta, tol, every),
+    'waste': lambda field, steps, types, coeffs, tol, every: ca_steps(types, field, steps, coeffs, tol, every),
+    'energy_diffusion': lambda field, steps, types, baseline, alpha, beta, tol, every:
+        diffuse_energy(field, types, baseline, steps, alpha, beta, tol, every),
+}
+
+def iterate(advance, field, steps, tol=None, every=CHECK_EVERY):
+    # relax's schedule for a backend that runs n steps at a time: the residual
+    # is the largest change in the last step of every stretch of every steps
+    field = np.array(field, dtype=float)
+    residual = 0.0
+    done = 0
+    while done < steps:
+        n = steps - done if tol is None else min(every - done % every, steps - done)
+        if n > 1:
+            field = advance(field, n - 1)
+        last = advance(field, 1)
+        change = last - field
+        residual = float(np.abs(change).max()) if change.size else 0.0
+        field = last
+        done += n
+        if tol is not None and residual < tol:
+            break
+    return field, {'steps': done, 'residual': residual, 'converged': tol is not None and residual < tol}
+
+def plain(field, params):
+    # one 2-D field with scalar parameters (and the type codes), what the loops
+    # and the one layout stack take. anything batched stays on numpy
+    return np.ndim(field) == 2 and all(np.ndim(p) == 0 or np.asarray(p).dtype.kind in 'iu' for p in params)
+
+def select(kernel, cells, exact=None):
+    exact = EXACT_MODE if exact is None else exact
+    name = OVERRIDE.get(kernel, OVERRIDE.get('*'))
+    if name is not None:
+        if name in BACKENDS[kernel] or name == 'numpy':
+            if available(name):
+                return name
+        warn(f"SIM_BACKEND {name} for {kernel} is not available, picking by size")
+    for limit, names in (AUTO_EXACT.get(kernel, AUTO[kernel]) if exact else AUTO[kernel]):
+        if limit is None or cells <= limit:
+            return next(n for n in names if available(n))
+
+_warned = set()
+
+def warn(message):
+    if message not in _warned:
+        _warned.add(message)
+        print(f"kernels: {message}", file=sys.stderr)
+
+# every backend is run once against python on a small layout before its first
+# real use. a backend that does not match falls back to numpy for the process
+CHECK_SIZE, CHECK_STEPS = 12, 8
+TOLERANCE = 1e-5
+_checked = {}
+_check_lock = threading.Lock()
+
+def check_case(kernel, seed=0):
+    # (field, steps, params) of a random layout with every type in it
+    rng = np.random.default_rng(seed)
+    types = rng.integers(0, len(TYPES), (CHECK_SIZE, CHECK_SIZE)).astype(np.uint8)
+    if kernel == 'heat':
+        return 20.0 + SOURCE[types], CHECK_STEPS, (20.0, 0.01, 0.01)
+    if kernel == 'waste':
+        return wastemaker(types, rng.uniform(10, 40, types.shape)), CHECK_STEPS, (types, COEFFS)
+    matrix = energy_matrix(types)
+    return matrix, CHECK_STEPS, (types, energy_baseline(matrix), 0.02, 0.01)
+
+def compare(kernel, name, seed=0):
+    # largest difference from python relative to the field's scale
+    field, steps, params = check_case(kernel, seed)
+    expected = iterate(BACKENDS[kernel]['python'](*params), field, steps)[0]
+    if name == 'numpy':
+        got = NUMPY[kernel](field, steps, *params, None, CHECK_EVERY)[0]
+    else:
+        got = iterate(BACKENDS[kernel][name](*params), field, steps)[0]
+    return float(np.abs(got - expected).max() / max(np.abs(expected).max(), 1.0))
+
+def verified(kernel, name):
+    with _check_lock:
+        if (kernel, name) not in _checked:
+            error = compare(kernel, name)
+            exact = name in EXACT[kernel]
+            _checked[kernel, name] = error == 0 if exact else error <= TOLERANCE
+            if not _checked[kernel, name]:
+                warn(f"{name} {kernel} is {error:.1e} off the reference, using numpy")
+        return _checked[kernel, name]
+
+def run(kernel, field, steps, *params, tol=None, every=CHECK_EVERY, backend=None, exact=None):
+    # (field, info) after at most steps steps, like relax.relax
+    name = 'numpy'
+    if plain(field, params):
+        name = backend or select(kernel, np.size(field), exact)
+    if name != 'numpy' and verified(kernel, name):
+        return iterate(BACKENDS[kernel][name](*params), field, steps, tol, every)
+    return NUMPY[kernel](field, steps, *params, tol, every)
+
+def random_case(kernel, size, seed=0):
+    rng = np.random.default_rng(seed)
+    types = rng.integers(0, len(TYPES), (size, size)).astype(np.uint8)
+    if kernel == 'heat':
+        return 20.0 + SOURCE[types], 75, (20.0, 0.01, 0.01)
+    if kernel == 'waste':
+        return wastemaker(types, rng.uniform(10, 40, types.shape)), 10, (types, COEFFS)
+    matrix = energy_matrix(types)
+    return matrix, 50, (types, energy_baseline(matrix), 0.02, 0.01)
+
+if __name__ == '__main__':
+    # python kernels.py [size ...]: every backend per kernel and size, best of 3 ms per run
+    # and how far it is from python. python itself only runs up to 64x64
+    sizes = [int(a) for a in sys.argv[1:]] or [32, 128, 512, 1024]
+    names = ['python', 'numpy'] + [n for n in ('numba', 'torch') if available(n)]
+    for kernel in KERNELS:
+        for name in names[1:]:
+            verified(kernel, name)  # compiles and checks outside the timing
+        print(f"{kernel}: check error {', '.join(f'{n} {compare(kernel, n, 1):.1e}' for n in names[1:])}")
+        for size in sizes:
+            field, steps, params = random_case(kernel, size)
+            row = []
+            for name in names:
+                if name == 'python' and size > 64:
+                    continue
+                best = float('inf')
+                for _ in range(1 if name == 'python' else 3):
+                    start = time.perf_counter()
+                    run(kernel, field, steps, *params, backend=name)
+                    best = min(best, time.perf_counter() - start)
+                row.append(f"{name} {best * 1000:8.1f}")
+            print(f"  {size:5d}x{size:<5d} " + "  ".join(row) + f"   auto: {select(kernel, size * size)}")
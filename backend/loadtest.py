@@ -0,0 +1,383 @@
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from climate import SCENARIO, parse_years
+
+# load test for /api/evaluate without NASA's THREDDS server:
+#   python loadtest.py --spawn 2 --concurrency 1 4 8 --duration 30
+# serves synthetic tasmax files from a local stand-in, starts gunicorn with
+# WEB_WORKERS=2 and CLIMATE_URL pointing at the stand-in, then reports latency
+# percentiles, throughput, errors and the Server-Timing stages per concurrency
+# level. --target http://host:5000 drives a server that is already running,
+# started with the CLIMATE_URL this prints and an empty CLIMATE_DIR.
+# the stand-in speaks plain http with byte ranges like THREDDS' fileServer,
+# netcdf opens it with #mode=bytes and only reads the chunks it needs
+STANDIN_PATH = "/thredds/fileServer/{scenario}/tasmax_{year}.nc"
+CHUNK = 40
+
+def synthetic_year(path, year, days=365, resolution=0.25):
+    # a tasmax file laid out like NEX-GDDP-CMIP6: daily kelvin on lat -89.875..89.875
+    # and lon 0.125..359.875 at 0.25 degrees. warm at the equator, a seasonal cycle
+    # away from it and a few degrees of fixed east-west wobble. chunked in lat/lon
+    # tiles over the whole year, so one point is one chunk
+    import netCDF4
+    lat = np.arange(-90 + resolution / 2, 90, resolution)
+    lon = np.arange(resolution / 2, 360, resolution)
+    season = np.cos(2 * np.pi * (np.arange(days) - 200) / 365.0).astype('f4')
+    wobble = (3 * np.sin(np.radians(lon) * 5 + year)).astype('f4')
+    partial = path + ".tmp"
+    with netCDF4.Dataset(partial, 'w', format='NETCDF4') as nc:
+        nc.createDimension('time', days)
+        nc.createDimension('lat', len(lat))
+        nc.createDimension('lon', len(lon))
+        nc.createVariable('time', 'f8', ('time',))[:] = np.arange(days) + 0.5
+        nc['time'].units = f"days since {year}-01-01"
+        nc.createVariable('lat', 'f8', ('lat',))[:] = lat
+        nc['lat'].units = "degrees_north"
+        nc.createVariable('lon', 'f8', ('lon',))[:] = lon
+        nc['lon'].units = "degrees_east"
+        tasmax = nc.createVariable('tasmax', 'f4', ('time', 'lat', 'lon'), zlib=True, complevel=1, shuffle=True,
+                                   least_significant_digit=1, chunksizes=(days, CHUNK, CHUNK))
+        tasmax.units = "K"
+        tasmax.standard_name = "air_temperature"
+        for start in range(0, len(lat), CHUNK):
+            band = lat[start:start + CHUNK]
+            base = (303.0 - 40.0 * (np.abs(band) / 90.0) ** 1.5).astype('f4')
+            amplitude = (12.0 * np.sin(np.radians(band))).astype('f4')
+            tasmax[:, start:start + CHUNK, :] = (base[None, :, None] + season[:, None, None] * amplitude[None, :, None]
+                                                + wobble[None, None, :])
+    os.replace(partial, path)
+    return path
+
+class StandIn:
+    # the synthetic files over http, with an optional delay per request to play
+    # a far away server. counts requests and bytes for the report
+    def __init__(self, root, days=365, resolution=0.25, latency=0.0, host="127.0.0.1", port=0):
+        self.root = root
+        self.days = days
+        self.resolution = resolution
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        os.makedirs(root, exist_ok=True)
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{STANDIN_PATH}#mode=bytes"
+
+    def path(self, scenario, year):
+        # files differ with the shape, so each shape gets its own directory
+        return os.path.join(self.root, f"{self.days}d-{self.resolution}deg", f"tasmax_{scenario}_{year}.nc")
+
+    def prepare(self, scenario, years, workers=None):
+        # writes the missing years up front, one process each, so no request waits on one
+        missing = [year for year in years if not os.path.exists(self.path(scenario, year))]
+        if missing:
+            os.makedirs(os.path.dirname(self.path(scenario, missing[0])), exist_ok=True)
+            print(f"writing {len(missing)} synthetic year(s) to {os.path.dirname(self.path(scenario, missing[0]))}")
+            with ProcessPoolExecutor(workers) as pool:
+                list(pool.map(synthetic_year, [self.path(scenario, y) for y in missing], missing,
+                              [self.days] * len(missing), [self.resolution] * len(missing)))
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="stand-in", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def handler(self):
+        standin = self
+        pattern = re.compile(re.escape(STANDIN_PATH).replace(r'\{scenario\}', r'(?P<scenario>[\w-]+)')
+                             .replace(r'\{year\}', r'(?P<year>\d+)') + '$')
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.respond(body=False)
+
+            def do_GET(self):
+                self.respond(body=True)
+
+            def respond(self, body):
+                if standin.latency:
+                    time.sleep(standin.latency)
+                match = pattern.match(self.path.split('?')[0])
+                path = match and standin.path(match['scenario'], int(match['year']))
+                if not path or not os.path.exists(path):
+                    self.send_error(404)
+                    return
+                size = os.path.getsize(path)
+                first, last = 0, size - 1
+                ranged = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+                if ranged:
+                    first = int(ranged[1])
+                    last = min(int(ranged[2]), size - 1) if ranged[2] else size - 1
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {first}-{last}/{size}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(last - first + 1))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+                if body:
+                    with open(path, 'rb') as f:
+                        f.seek(first)
+                        self.wfile.write(f.read(last - first + 1))
+                with standin.lock:
+                    standin.requests += 1
+                    standin.bytes += (last - first + 1) if body else 0
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+def weighted(spec):
+    # "16:4,32:2,64" -> ([16, 32, 64], [4, 2, 1])
+    values, weights = [], []
+    for part in filter(None, spec.split(',')):
+        value, _, weight = part.partition(':')
+        values.append(int(value))
+        weights.append(float(weight or 1))
+    return values, weights
+
+class Workload:
+    # random evaluate bodies: grid sizes from the weighted mix, a year from the
+    # list, and a location that is fresh every time (locations=0) or one of a
+    # fixed set, which decides how often the climate lookup is cached
+    def __init__(self, sizes, years, locations=0, steps=10, fmt='raw', seed=0):
+        self.sizes, self.weights = weighted(sizes)
+        self.years = years
+        self.steps = steps
+        self.format = fmt
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.points = [self.point() for _ in range(locations)]
+
+    def point(self):
+        # somewhere people live, roughly
+        return self.rng.uniform(-55, 70), self.rng.uniform(-180, 180)
+
+    def body(self):
+        with self.lock:
+            size = self.rng.choices(self.sizes, self.weights)[0]
+            lat, lon = self.rng.choice(self.points) if self.points else self.point()
+            year = self.rng.choice(self.years)
+            types = [[self.rng.choice('dlgbe') for _ in range(size)] for _ in range(size)]
+        return {'gridSize': size, 'grid': [[{'type': t, 'color': ''} for t in row] for row in types],
+                'latitude': lat, 'longitude': lon, 'yr': year, 'steps': self.steps, 'format': self.format}
+
+def server_timing(header):
+    # "parse;dur=0.4, heat;dur=12.1" -> {'parse': 0.4, 'heat': 12.1}
+    stages = {}
+    for part in filter(None, (p.strip() for p in (header or '').split(','))):
+        name, _, dur = part.partition(';dur=')
+        if dur:
+            stages[name] = float(dur)
+    return stages
+
+def call(target, body, timeout):
+    # (status, seconds, stages, error). status 0 when no response came back at all
+    data = json.dumps(body).encode()
+    req = urllib.request.Request(target + '/api/evaluate', data=data, headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            response.read()
+            return response.status, time.perf_counter() - start, server_timing(response.headers.get('Server-Timing')), None
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code, time.perf_counter() - start, server_timing(e.headers.get('Server-Timing')), f"HTTP {e.code}"
+    except (urllib.error.URLError, OSError) as e:
+        return 0, time.perf_counter() - start, {}, str(getattr(e, 'reason', e))
+
+def drive(target, workload, concurrency, duration=None, requests=None, timeout=600):
+    # closed loop: concurrency clients each send their next request when the last
+    # one returns, until duration seconds are up or requests have been sent
+    samples = []
+    lock = threading.Lock()
+    sent = [0]
+    deadline = time.perf_counter() + duration if duration else None
+
+    def client():
+        while deadline is None or time.perf_counter() < deadline:
+            with lock:
+                if requests is not None and sent[0] >= requests:
+                    return
+                sent[0] += 1
+            result = call(target, workload.body(), timeout)
+            with lock:
+                samples.append(result)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, time.perf_counter() - start
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+def summarize(concurrency, samples, elapsed):
+    ok = [s for s in samples if s[0] == 200]
+    errors = {}
+    for status, _, _, error in samples:
+        if status != 200:
+            errors[error] = errors.get(error, 0) + 1
+    stages = {}
+    for _, _, timing, _ in ok:
+        for name, ms in timing.items():
+            stages.setdefault(name, []).append(ms)
+    return {
+        'concurrency': concurrency,
+        'requests': len(samples),
+        'seconds': elapsed,
+        'throughput': len(ok) / elapsed if elapsed else 0.0,
+        'error_rate': (len(samples) - len(ok)) / len(samples) if samples else 0.0,
+        'errors': errors,
+        'latency_ms': percentiles([s[1] * 1000 for s in ok]),
+        'stages_ms': {name: percentiles(values) for name, values in stages.items()},
+    }
+
+def report(level):
+    def ms(p):
+        return '-' if p is None else f"{p:.0f}"
+    lat = level['latency_ms']
+    lines = [f"concurrency {level['concurrency']}: {level['requests']} requests in {level['seconds']:.1f} s, "
+             f"{level['throughput']:.2f} req/s, {level['error_rate']:.1%} errors",
+             f"  latency ms   p50 {ms(lat['p50'])}  p95 {ms(lat['p95'])}  p99 {ms(lat['p99'])}"]
+    for name, p in sorted(level['stages_ms'].items(), key=lambda kv: -(kv[1]['p50'] or 0)):
+        lines.append(f"  {name:12s} p50 {ms(p['p50']):>8s}  p95 {ms(p['p95']):>8s}  p99 {ms(p['p99']):>8s}")
+    for error, count in level['errors'].items():
+        lines.append(f"  {count} x {error}")
+    return '\n'.join(lines)
+
+def spawn(workers, threads, climate_url, port, climate_dir, model_path=None):
+    # gunicorn with the repo's config, talking to the stand-in
+    env = dict(os.environ, BIND=f"127.0.0.1:{port}", WEB_WORKERS=str(workers), WEB_THREADS=str(threads),
+               CLIMATE_URL=climate_url, CLIMATE_DIR=climate_dir)
+    if model_path:
+        env['MODEL_PATH'] = model_path
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'backend:app'],
+                            cwd=here, env=env, stdout=subprocess.DEVNULL)
+
+def wait_ready(target, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(target + '/api/ready', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{target} was not ready after {timeout} s")
+
+def random_weights(directory):
+    # the unet costs the same with untrained weights, for trees without model.pth
+    import torch
+    from model import unet
+    path = os.path.join(directory, "random-unet.pth")
+    torch.save(unet().state_dict(), path)
+    return path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test /api/evaluate against a local stand-in for the THREDDS climate server")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--target", default=None, help="base url of a running backend, e.g. http://127.0.0.1:5000")
+    target.add_argument("--spawn", type=int, default=None, metavar="WORKERS", help="start gunicorn with this many workers")
+    parser.add_argument("--threads", type=int, default=8, help="WEB_THREADS of the spawned gunicorn (default 8)")
+    parser.add_argument("--port", type=int, default=5055, help="port of the spawned gunicorn (default 5055)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4], help="clients per level (default 1 4)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per level (default 30)")
+    parser.add_argument("--requests", type=int, default=None, help="requests per level instead of a duration")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed requests before the first level (default 2)")
+    parser.add_argument("--sizes", default="16:4,32:2,64:1", help="grid size mix, size:weight pairs (default 16:4,32:2,64:1)")
+    parser.add_argument("--years", nargs="+", default=["2020-2024"], help="years or ranges to draw from (default 2020-2024)")
+    parser.add_argument("--locations", type=int, default=0,
+                        help="distinct locations to draw from, 0 for a new one every request (default 0)")
+    parser.add_argument("--steps", type=int, default=10, help="diffusion steps per request, 1000 is the full run (default 10)")
+    parser.add_argument("--format", default='raw', help="response format (default raw)")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before a request counts as failed")
+    parser.add_argument("--data", default=os.path.join(tempfile.gettempdir(), "climagrid-standin"),
+                        help="where the synthetic years are kept between runs")
+    parser.add_argument("--days", type=int, default=365, help="days per synthetic year (default 365)")
+    parser.add_argument("--resolution", type=float, default=0.25, help="synthetic grid spacing in degrees (default 0.25)")
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay the stand-in adds to every request")
+    parser.add_argument("--standin-port", type=int, default=0, help="port of the stand-in (default any free one)")
+    parser.add_argument("--serve", action="store_true", help="only run the stand-in and print its CLIMATE_URL")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="write every level's numbers here as json")
+    args = parser.parse_args()
+
+    years = parse_years(args.years)
+    standin = StandIn(args.data, args.days, args.resolution, args.latency_ms / 1000, port=args.standin_port)
+    standin.prepare(SCENARIO, years)
+    standin.start()
+    print(f"stand-in serving {SCENARIO} {years[0]}-{years[-1]} as CLIMATE_URL={standin.url}")
+    if args.serve:
+        threading.Event().wait()
+
+    scratch = tempfile.mkdtemp(prefix="climagrid-loadtest-")
+    server = None
+    try:
+        if args.spawn:
+            here = os.path.dirname(os.path.abspath(__file__))
+            model_path = None
+            if not os.environ.get("MODEL_PATH") and not os.path.exists(os.path.join(here, "model.pth")):
+                print("model.pth not found, the spawned server gets random unet weights")
+                model_path = random_weights(scratch)
+            # an empty climate store, so every new location goes to the stand-in
+            server = spawn(args.spawn, args.threads, standin.url, args.port, os.path.join(scratch, "climate"), model_path)
+            base = f"http://127.0.0.1:{args.port}"
+        else:
+            base = (args.target or "http://127.0.0.1:5000").rstrip('/')
+        wait_ready(base)
+        workload = Workload(args.sizes, years, args.locations, args.steps, args.format, args.seed)
+        if args.warmup:
+            drive(base, workload, 1, requests=args.warmup, timeout=args.timeout)
+        levels = []
+        for concurrency in args.concurrency:
+            before = (standin.requests, standin.bytes)
+            samples, elapsed = drive(base, workload, concurrency, None if args.requests else args.duration,
+                                     args.requests, args.timeout)
+            level = summarize(concurrency, samples, elapsed)
+            level['standin'] = {'requests': standin.requests - before[0], 'bytes': standin.bytes - before[1]}
+            levels.append(level)
+            print(report(level))
+            print(f"  stand-in     {level['standin']['requests']} range requests, {level['standin']['bytes'] / 2 ** 20:.1f} MiB",
+                  flush=True)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump({'target': base, 'workers': args.spawn, 'threads': args.threads if args.spawn else None,
+                           'sizes': args.sizes, 'years': args.years, 'locations': args.locations,
+                           'steps': args.steps, 'levels': levels}, f, indent=2)
+            print(f"wrote {args.out}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        standin.stop()
+        shutil.rmtree(scratch, ignore_errors=True)
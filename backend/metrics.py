@@ -0,0 +1,230 @@
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# per process, so under gunicorn every worker keeps its own numbers and a
+# scrape of /metrics only sees the worker that answered it
+PREFIX = 'climagrid'
+SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES = tuple(2 ** n for n in range(10, 28, 2))
+local = threading.local()
+
+def peak_rss():
+    # ru_maxrss is kilobytes on linux and bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+def tensor_memory():
+    # only looks at torch if something else already imported it, and only cuda
+    # keeps allocator stats. cpu tensors show up in the rss numbers instead
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available():
+        return {}
+    return {'allocated': torch.cuda.memory_allocated(), 'peak': torch.cuda.max_memory_allocated()}
+
+def labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def lines(self, name, pairs):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield f'{name}_bucket{labels(pairs + (("le", bound),))} {total}'
+        yield f'{name}_bucket{labels(pairs + (("le", "+Inf"),))} {self.count}'
+        yield f'{name}_sum{labels(pairs)} {self.sum}'
+        yield f'{name}_count{labels(pairs)} {self.count}'
+
+class Registry:
+    # stage and request numbers in the prometheus text format. gauges are
+    # callbacks returning {label value: number} read at scrape time
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_seconds = {}
+        self.stage_cpu = Counter()
+        self.stage_rss = Counter()
+        self.requests = Counter()
+        self.request_seconds = {}
+        self.payload = {}
+        self.gauges = {}
+
+    def stage(self, name, wall, cpu, rss):
+        with self.lock:
+            self.stage_seconds.setdefault(name, Histogram(SECONDS)).observe(wall)
+            self.stage_cpu[name] += cpu
+            self.stage_rss[name] += rss
+
+    def request(self, route, status, seconds):
+        with self.lock:
+            self.requests[route, status] += 1
+            self.request_seconds.setdefault(route, Histogram(SECONDS)).observe(seconds)
+
+    def response(self, route, fmt, size):
+        with self.lock:
+            self.payload.setdefault((route, fmt), Histogram(BYTES)).observe(size)
+
+    def gauge(self, name, help, label, read):
+        self.gauges[name] = (help, label, read)
+
+    def render(self):
+        out = []
+
+        def family(name, kind, help):
+            out.append(f'# HELP {PREFIX}_{name} {help}')
+            out.append(f'# TYPE {PREFIX}_{name} {kind}')
+            return f'{PREFIX}_{name}'
+
+        with self.lock:
+            name = family('stage_seconds', 'histogram', 'Wall time per pipeline stage call')
+            for stage, hist in sorted(self.stage_seconds.items()):
+                out.extend(hist.lines(name, (('stage', stage),)))
+            name = family('stage_cpu_seconds_total', 'counter', 'CPU time of the thread that ran the stage')
+            out.extend(f'{name}{labels((("stage", s),))} {v}' for s, v in sorted(self.stage_cpu.items()))
+            name = family('stage_peak_rss_growth_bytes_total', 'counter', 'How far the process peak RSS rose while the stage ran')
+            out.extend(f'{name}{labels((("stage", s),))} {v}' for s, v in sorted(self.stage_rss.items()))
+            name = family('http_requests_total', 'counter', 'Requests by route and status')
+            out.extend(f'{name}{labels((("route", r), ("status", s)))} {v}' for (r, s), v in sorted(self.requests.items()))
+            name = family('http_request_seconds', 'histogram', 'Wall time per request')
+            for route, hist in sorted(self.request_seconds.items()):
+                out.extend(hist.lines(name, (('route', route),)))
+            name = family('response_bytes', 'histogram', 'Encoded response body size')
+            for (route, fmt), hist in sorted(self.payload.items()):
+                out.extend(hist.lines(name, (('route', route), ('format', fmt))))
+        name = family('peak_rss_bytes', 'gauge', 'Peak resident set size of this process')
+        out.append(f'{name} {peak_rss()}')
+        rss = current_rss()
+        if rss is not None:
+            name = family('rss_bytes', 'gauge', 'Resident set size of this process')
+            out.append(f'{name} {rss}')
+        tensors = tensor_memory()
+        if tensors:
+            name = family('tensor_bytes', 'gauge', 'CUDA memory held by torch tensors')
+            out.extend(f'{name}{labels((("kind", k),))} {v}' for k, v in tensors.items())
+        for gauge, (help, label, read) in sorted(self.gauges.items()):
+            name = family(gauge, 'gauge', help)
+            out.extend(f'{name}{labels(((label, k),))} {v}' for k, v in sorted(read().items()))
+        return '\n'.join(out) + '\n'
+
+registry = Registry()
+
+class Trace:
+    # the stage spans of one request, summed per name for the Server-Timing header
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.wall = Counter()
+        self.order = []
+
+    def add(self, name, wall):
+        with self.lock:
+            if name not in self.wall:
+                self.order.append(name)
+            self.wall[name] += wall
+
+    def header(self):
+        # Server-Timing: parse;dur=0.4, climate;dur=12.1, ..., total;dur=..
+        with self.lock:
+            parts = [f'{name};dur={self.wall[name] * 1000:.1f}' for name in self.order]
+        parts.append(f'total;dur={(time.perf_counter() - self.start) * 1000:.1f}')
+        return ', '.join(parts)
+
+    def wrap(self, name, fn):
+        # fn run as a span of this trace on whatever thread calls it
+        def traced(*args, **kwargs):
+            with bound(self), span(name):
+                return fn(*args, **kwargs)
+        return traced
+
+@contextmanager
+def bound(trace):
+    # spans opened on this thread go to trace until the block ends
+    previous = getattr(local, 'trace', None)
+    local.trace = trace
+    try:
+        yield trace
+    finally:
+        local.trace = previous
+
+@contextmanager
+def span(name):
+    # wall and thread cpu time plus peak rss growth of the block, into the
+    # registry and the current thread's trace if it has one. spans nest, an
+    # inner one (rasterize) is also counted in the stage around it
+    trace = getattr(local, 'trace', None)
+    wall, cpu, rss = time.perf_counter(), time.thread_time(), peak_rss()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        registry.stage(name, wall, time.thread_time() - cpu, peak_rss() - rss)
+        if trace is not None:
+            trace.add(name, wall)
+
+class StackSampler:
+    # poor man's py-spy: every interval it grabs the stack of every thread but
+    # its own. stop() returns {folded stack: samples}, the "a;b;c 12" format
+    # py-spy record --format raw writes and speedscope / flamegraph.pl read
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.done.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                # idle pool workers and the idle batcher are waiting on a queue, not on the request
+                if stack[0].startswith('_worker (thread.py') or any(entry.startswith('get (queue.py') for entry in stack):
+                    continue
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        return self.stacks
+
+def write_folded(stacks, path):
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
@@ -177,7 +177,3 @@ class unet(nn.Module):
 
         x = self.finalconv(x)
         return x
-model = unet()
-print("Num params: ", sum(p.numel() for p in model.parameters()))
-model
-        
@@ -0,0 +1,64 @@
+import numpy as np
+
+# residual checks cost a pass over the field, so they only happen every
+# CHECK_EVERY steps (and on the last one)
+CHECK_EVERY = 5
+
+def relax(step, field, steps, tol=None, every=CHECK_EVERY, region=Ellipsis):
+    # runs step(src, dst) at most steps times, ping-ponging between two buffers
+    # allocated once. step writes the next field into dst and must not keep
+    # references to either. the residual is the largest change of a cell in one
+    # step (within region, an index into the field, if given); with a tol the
+    # loop stops at the first check where it is below it.
+    # returns (field, {'steps', 'residual', 'converged'})
+    src = np.array(field, dtype=float)
+    dst = np.empty_like(src)
+    residual = 0.0
+    done = 0
+    while done < steps:
+        step(src, dst)
+        done += 1
+        if done == steps or (tol is not None and done % every == 0):
+            change = dst[region] - src[region]
+            residual = float(np.abs(change).max()) if change.size else 0.0
+            if tol is not None and residual < tol:
+                src, dst = dst, src
+                break
+        src, dst = dst, src
+    return src, {'steps': done, 'residual': residual, 'converged': tol is not None and residual < tol}
+
+class EdgeLaplacian:
+    # heat.laplacian into preallocated buffers, same additions in the same order
+    # so the result is bit for bit the same
+    def __init__(self, shape):
+        height, width = shape
+        self.padded = np.empty((height + 2, width + 2))
+        self.out = np.empty(shape)
+        self.scratch = np.empty(shape)
+
+    def __call__(self, field):
+        p = self.padded
+        p[1:-1, 1:-1] = field
+        p[0, 1:-1], p[-1, 1:-1] = field[0], field[-1]
+        p[1:-1, 0], p[1:-1, -1] = field[:, 0], field[:, -1]
+        out = self.out
+        np.add(p[:-2, 1:-1], p[2:, 1:-1], out=out)
+        out += p[1:-1, :-2]
+        out += p[1:-1, 2:]
+        np.multiply(field, 4, out=self.scratch)
+        out -= self.scratch
+        return out
+
+def relaxation_step(shape, alpha, beta, target):
+    # dst = src + alpha * lap(src) - beta * (src - target), the update heat and
+    # the energy smoothing share
+    lap = EdgeLaplacian(shape)
+    pull = np.empty(shape)
+
+    def step(src, dst):
+        np.multiply(lap(src), alpha, out=dst)
+        np.add(src, dst, out=dst)
+        np.subtract(src, target, out=pull)
+        np.multiply(pull, beta, out=pull)
+        np.subtract(dst, pull, out=dst)
+    return step
@@ -16,6 +16,14 @@ def cosine_beta_schedule(timesteps, s=0.008):
     return torch.clip(betas, 0, 0.999)  
 
 
+def ddim_timesteps(steps, timesteps=None):
+    # evenly strided subset of the training timesteps, high to low, always ending on 0
+    timesteps = T if timesteps is None else timesteps
+    steps = max(1, min(int(steps), timesteps))
+    ts = torch.linspace(timesteps - 1, 0, steps).round().long()
+    return torch.unique_consecutive(ts)
+
+
 def get_index_from_list(vals, t, x_shape):
     #something something index getter
     batch_size = t.shape[0]
@@ -46,3 +54,37 @@ sqrt_recip_alphas = torch.sqrt(1.0 / alphas)
 sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
 sqrt_one_minus_alphas_cumprod = torch.sqrt(1. - alphas_cumprod)
 posterior_variance = betas * (1. - alphas_cumprod_prev) / (1. - alphas_cumprod)
+
+
+class SamplerState:
+    # everything the reverse loop needs per timestep, computed once per device.
+    # the *_t lists hold the same float32 values as python floats so the loop
+    # can scale tensors without gathers or host/device copies
+    def __init__(self, device="cpu"):
+        self.device = torch.device(device)
+        coef1 = betas * torch.sqrt(alphas_cumprod_prev) / (1.0 - alphas_cumprod)
+        coef2 = (1.0 - alphas_cumprod_prev) * torch.sqrt(alphas) / (1.0 - alphas_cumprod)
+        self.tables = {
+            "sqrt_alphas_cumprod": sqrt_alphas_cumprod,
+            "sqrt_one_minus_alphas_cumprod": sqrt_one_minus_alphas_cumprod,
+            "alphas_cumprod": alphas_cumprod,
+            "posterior_mean_coef1": coef1,
+            "posterior_mean_coef2": coef2,
+            "posterior_std": torch.sqrt(posterior_variance),
+        }
+        for name, table in self.tables.items():
+            setattr(self, name, table.to(self.device))
+            setattr(self, name + "_t", table.tolist())
+        self.timesteps = torch.arange(T, device=self.device, dtype=torch.long)
+
+    def t_batch(self, t, batch_size=1):
+        # view into the preallocated timestep tensor, no torch.full per step
+        return self.timesteps[t:t + 1].expand(batch_size)
+
+_sampler_states = {}
+
+def sampler_state(device="cpu"):
+    key = str(device)
+    if key not in _sampler_states:
+        _sampler_states[key] = SamplerState(device)
+    return _sampler_states[key]
@@ -0,0 +1,110 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+class Limiter:
+    # caps the requests doing work at once. acquire never waits, a full limiter
+    # means the caller answers 429 instead of queueing behind the unet
+    def __init__(self, limit):
+        self.limit = limit
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.in_flight += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def summary(self):
+        with self.lock:
+            return {'limit': self.limit, 'in_flight': self.in_flight, 'rejected': self.rejected}
+
+class Readiness:
+    # runs warm_up once per process in the background. threads do not survive a
+    # fork, so a preloaded gunicorn master never warms up itself and each worker
+    # starts its own from post_fork (or on its first request)
+    def __init__(self, warm_up):
+        self.warm_up = warm_up
+        self.lock = threading.Lock()
+        self.pid = None
+        self.ready = threading.Event()
+        self.error = None
+        self.seconds = None
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.ready = threading.Event()
+            self.error = None
+        threading.Thread(target=self.run, name="warm-up", daemon=True).start()
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self.warm_up()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = str(e)
+            return
+        self.seconds = time.perf_counter() - start
+        print(f"Worker {os.getpid()} warmed up in {self.seconds:.2f} s")
+        self.ready.set()
+
+    def status(self):
+        return {'ready': self.ready.is_set(), 'pid': os.getpid(), 'error': self.error,
+                'warm_up_seconds': None if self.seconds is None else round(self.seconds, 2)}
+
+def import_report(module, top=15):
+    # python -X importtime in a fresh interpreter, summed up per module that
+    # module imports directly. cumulative includes everything they pull in
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                         capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    # children are printed before their parent, so module's subtree is
+    # everything between the previous top level line and its own
+    subtree, total = [], None
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth > 0:
+            subtree.append((depth, int(cumulative), name.strip()))
+        elif name.strip() == module:
+            total = int(cumulative)
+            break
+        else:
+            subtree = []
+    if total is None:
+        return out.stderr
+    direct = sorted(((us, name) for depth, us, name in subtree if depth == 1), reverse=True)
+    lines = [f"import {module}: {total / 1e6:.2f} s"]
+    lines += [f"  {name:<24} {us / 1e6:8.3f} s" for us, name in direct[:top]]
+    return "\n".join(lines)
+
+def check_seed(seed):
+    # None or a whole number a torch generator takes, [0, 2**64). checked when a
+    # request comes in, a bad one would otherwise fail everyone in its unet batch
+    if seed is None:
+        return None
+    if isinstance(seed, bool) or (isinstance(seed, float) and not seed.is_integer()):
+        raise ValueError(f"seed must be a whole number, got {seed!r}")
+    seed = int(seed)
+    if not 0 <= seed < 2 ** 64:
+        raise ValueError(f"seed {seed} is outside [0, 2**64)")
+    return seed
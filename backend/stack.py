@@ -0,0 +1,252 @@
+import sys
+import time
+import numpy as np
+from citygrid import TYPES, EMPTY, DENSE, LIGHT, GREEN, WATER, as_grid
+from heat import SOURCE
+from energy import CELL_AREA, INITIAL_ENERGY_DEMAND
+from waste import BASELINE_TEMP, COEFFS, TEMP_COEFF, neumannNeighbors, transfer_table, wastemaker
+
+# the simulations over a stack of layouts, types shaped (N, H, W) with the type
+# codes from citygrid.TYPES. arrays stay numpy unless the stack is a torch tensor
+# (see to_stack(device=...)), then every step runs on that tensor's device.
+# per sample parameters are scalars or one value per layout
+
+def is_torch(x):
+    return type(x).__module__.startswith('torch')
+
+def to_stack(grids, device=None):
+    # CityGrids, lists of rows of type names, or an (N, H, W) code array, to a type stack
+    types = grids if isinstance(grids, np.ndarray) or is_torch(grids) else np.stack([as_grid(g).types for g in grids])
+    if device is not None:
+        import torch
+        types = torch.as_tensor(types, device=device)
+    return types
+
+def to_numpy(x):
+    return x.detach().cpu().numpy() if is_torch(x) else np.asarray(x)
+
+def floats(values, like):
+    # values as a float array on like's backend; float64 unless the tensor lives on a gpu
+    if is_torch(like):
+        import torch
+        dtype = torch.float64 if like.device.type == 'cpu' else torch.float32
+        return torch.as_tensor(values, dtype=dtype, device=like.device)
+    return np.asarray(values, dtype=float)
+
+def per_sample(value, like):
+    # scalar or one value per layout, shaped to broadcast over (N, H, W)
+    value = floats(value, like)
+    return value.reshape(-1, 1, 1) if value.ndim else value
+
+def lookup(table, types):
+    table = floats(table, types)
+    return table[types.long()] if is_torch(types) else table[types]
+
+def where(cond, a, b):
+    if is_torch(cond):
+        # python scalars would come back in torch's default float32
+        import torch
+        return torch.where(cond, *(v if torch.is_tensor(v) else floats(v, cond) for v in (a, b)))
+    return np.where(cond, a, b)
+
+def pad_edge(x):
+    # one cell around the last two axes, copied from the border
+    if is_torch(x):
+        import torch.nn.functional as F
+        return F.pad(x[:, None], (1, 1, 1, 1), mode='replicate')[:, 0]
+    return np.pad(x, [(0, 0), (1, 1), (1, 1)], mode='edge')
+
+def span(d, n):
+    # (target, source) slices along one axis for a neighbor offset d
+    return (slice(max(-d, 0), n - max(d, 0)), slice(max(d, 0), n - max(-d, 0)))
+
+def shift(x, di, dj, fill=0):
+    # value of the (di, dj) neighbor at every cell, fill where it falls off the grid
+    h, w = x.shape[-2:]
+    if is_torch(x):
+        import torch
+        out = torch.full_like(x, fill)
+    else:
+        out = np.full_like(x, fill)
+    (ty, sy), (tx, sx) = span(di, h), span(dj, w)
+    out[:, ty, tx] = x[:, sy, sx]
+    return out
+
+def laplacian(field):
+    padded = pad_edge(field)
+    return (padded[:, :-2, 1:-1] + padded[:, 2:, 1:-1] + padded[:, 1:-1, :-2] + padded[:, 1:-1, 2:]
+            - 4 * field)
+
+def neighbor_sum(plane):
+    return sum(shift(plane, di, dj) for di, dj in neumannNeighbors)
+
+def window_sum(plane, radius):
+    # separable box sum, fine for the small radii the rules use
+    rows = sum(shift(plane, d, 0) for d in range(-radius, radius + 1))
+    return sum(shift(rows, 0, d) for d in range(-radius, radius + 1))
+
+def heat_stack(types, airtemp, steps=75, alpha=0.01, beta=0.01):
+    # simheat's explicit update for every layout at once, returns the (N, H, W) fields
+    airtemp = per_sample(airtemp, types)
+    return heat_steps_stack(airtemp + lookup(SOURCE, types), airtemp, steps, alpha, beta)
+
+def heat_steps_stack(output, airtemp, steps=75, alpha=0.01, beta=0.01):
+    # the update from given (N, H, W) fields
+    airtemp, alpha, beta = (per_sample(v, output) for v in (airtemp, alpha, beta))
+    for _ in range(steps):
+        output = output + alpha * laplacian(output) - beta * (output - airtemp)
+    return output
+
+def waste_stack(types, temp, steps=10, coeffs=COEFFS):
+    # waste_field for every layout, coeffs is one dict or a list with one per layout.
+    # wastemaker at the baseline temp gives the per type amount, scaled the same way it does
+    w = lookup(wastemaker(np.arange(len(TYPES)), BASELINE_TEMP), types) * (1 + TEMP_COEFF * (temp - BASELINE_TEMP))
+    return waste_steps_stack(types, w, steps, coeffs)
+
+def waste_steps_stack(types, w, steps=10, coeffs=COEFFS):
+    # the automaton from given (N, H, W) waste fields
+    n = types.shape[0]
+    coeffs = list(coeffs) if isinstance(coeffs, (list, tuple)) else [coeffs] * n
+    table = floats(np.stack([transfer_table(c) for c in coeffs]), types)
+    overflow = per_sample([c['overflow'] for c in coeffs], types)
+    spread = per_sample([c['lighttrashspread'] for c in coeffs], types)
+    if is_torch(types):
+        import torch
+        sample = torch.arange(n, device=types.device)[:, None, None]
+    else:
+        sample = np.arange(n)[:, None, None]
+    codes = types.long() if is_torch(types) else types
+
+    masks = []
+    ones = floats(types >= 0, types)
+    for di, dj in neumannNeighbors:
+        neigh = shift(types, di, dj, fill=EMPTY)
+        inside = shift(ones, di, dj) > 0
+        masks.append({
+            'coef': where(inside, table[sample, codes, neigh.long() if is_torch(neigh) else neigh], 0.0),
+            'overflow': inside & (types == DENSE) & (neigh == LIGHT), #rule 1
+            'lightspread': inside & (types == LIGHT) & (neigh == LIGHT), #rule 7
+        })
+
+    for _ in range(steps):
+        delta = 0 * w
+        for (di, dj), m in zip(neumannNeighbors, masks):
+            flow = w * m['coef']
+            delta = delta - flow + shift(flow, -di, -dj)
+        for (di, dj), m in zip(neumannNeighbors, masks):
+            fire = m['overflow'] & (delta >= 100 + shift(delta, di, dj))
+            diff = w - shift(w, di, dj)
+            flow = where(fire, where(diff > 0, diff, 0.0) * overflow, 0.0)
+            delta = delta - flow + shift(flow, -di, -dj)
+        for (di, dj), m in zip(neumannNeighbors, masks):
+            fire = m['lightspread'] & (delta >= 50 + shift(delta, di, dj))
+            flow = where(fire, w * spread, 0.0)
+            delta = delta - flow + shift(flow, -di, -dj)
+        w = w + delta
+    return w
+
+def energy_stack(types, cool_roofs=None):
+    # energy_matrix for every layout, cool_roofs is an optional (N, H, W) mask
+    base = [INITIAL_ENERGY_DEMAND.get(name, INITIAL_ENERGY_DEMAND['e']) * CELL_AREA / 365.0 for name in TYPES]
+    low = types == LIGHT
+    high = types == DENSE
+    housing = low | high
+    matrix = lookup(base, types)
+
+    total_neighbors = window_sum(floats(types >= 0, types), 2) - 1
+    high_density_neighbors = window_sum(floats(high, types), 2) - floats(high, types)
+    green_space_neighbors = window_sum(floats(types == GREEN, types), 2) - floats(types == GREEN, types)
+    water_neighbors = window_sum(floats(types == WATER, types), 2) - floats(types == WATER, types)
+
+    has_neighbors = total_neighbors > 0
+    safe_total = where(has_neighbors, total_neighbors, 1.0)
+    crowded = has_neighbors & (high_density_neighbors >= safe_total / 2)
+    matrix = where(crowded, matrix * 1.04, matrix)
+
+    green_multiplier = where(green_space_neighbors / safe_total >= 0.20, 0.97, 1.0)
+    water_multiplier = where(water_neighbors / safe_total >= 0.10, 0.92, 1.0)
+    combined = green_multiplier * water_multiplier
+    combined = where(combined > 0.88, combined, 0.88)
+    matrix = where(has_neighbors, matrix * combined, matrix)
+
+    if cool_roofs is not None:
+        roofed = floats(cool_roofs, types) > 0
+        matrix = where(roofed & housing, matrix * 0.85, matrix)
+
+    min_allowed = lookup([base[DENSE] if code == DENSE else base[LIGHT] for code in range(len(TYPES))], types) * 0.88
+    return where(housing & (matrix < min_allowed), min_allowed, matrix)
+
+def energy_diffusion_stack(matrix, types, steps=50, alpha=0.02, beta=0.01, baseline=None):
+    # apply_energy_diffusion for every layout, each with its own baseline unless one is given
+    alpha, beta = per_sample(alpha, types), per_sample(beta, types)
+    if baseline is None:
+        positive = matrix > 0
+        count = floats(positive.sum((-2, -1)), types)
+        baseline = where(count > 0, where(positive, matrix, 0.0).sum((-2, -1)) / where(count > 0, count, 1.0), 0.0)
+    baseline = per_sample(baseline, types)
+    housing = (types == LIGHT) | (types == DENSE)
+    green, water = types == GREEN, types == WATER
+
+    neighbor_count = neighbor_sum(floats(types >= 0, types))
+    has_neighbors = neighbor_count > 0
+    safe_count = where(has_neighbors, neighbor_count, 1.0)
+    cooling = (neighbor_sum(floats(green, types)) / safe_count) * 0.15 * baseline \
+        + (neighbor_sum(floats(water, types)) / safe_count) * 0.25 * baseline
+
+    output = matrix
+    for _ in range(steps):
+        new_output = output + alpha * laplacian(output) - beta * (output - baseline)
+        new_output = where(housing, new_output - cooling, new_output)
+        new_output = where(green, -baseline * 0.3, new_output)
+        new_output = where(water, -baseline * 0.5, new_output)
+        new_output = where(housing & (new_output < 0), baseline * 0.1, new_output)
+        output = where(has_neighbors, new_output, output)
+    return output
+
+def energy_stats_stack(matrix, types):
+    # energy_summary's stats as one numpy array per key
+    matrix, types = to_numpy(matrix), to_numpy(types)
+    low, high = types == LIGHT, types == DENSE
+    low_energy = np.where(low, matrix, 0).sum((1, 2))
+    high_energy = np.where(high, matrix, 0).sum((1, 2))
+    low_count, high_count = low.sum((1, 2)), high.sum((1, 2))
+    return {
+        'total_energy_usage': matrix.sum((1, 2)),
+        'low_density_energy': low_energy,
+        'high_density_energy': high_energy,
+        'low_density_count': low_count,
+        'high_density_count': high_count,
+        'avg_energy_per_low_density': low_energy / np.maximum(low_count, 1),
+        'avg_energy_per_high_density': high_energy / np.maximum(high_count, 1),
+        'energy_efficiency_ratio': low_energy / np.maximum(high_energy, 1),
+    }
+
+if __name__ == '__main__':
+    # python stack.py [n] [size] [device]: loop over single grids vs one stacked pass
+    from heat import simheat
+    from waste import waste_field
+    from energy import energy_matrix, apply_energy_diffusion
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    device = sys.argv[3] if len(sys.argv) > 3 else None
+    rng = np.random.default_rng(0)
+    grids = [[list(row) for row in rng.choice(list('dlgbe'), (size, size))] for _ in range(n)]
+    temps = rng.uniform(0, 40, n)
+    if device is not None:
+        import torch  # keep the import out of the timing
+
+    start = time.perf_counter()
+    heat = [simheat(g, t)[2] for g, t in zip(grids, temps)]
+    waste = [waste_field(g, h) for g, h in zip(grids, heat)]
+    energy = [apply_energy_diffusion(energy_matrix(g), g) for g in grids]
+    loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    types = to_stack(grids, device)
+    heat_s = heat_stack(types, temps)
+    waste_s = waste_stack(types, heat_s)
+    energy_s = energy_diffusion_stack(energy_stack(types), types)
+    stacked = time.perf_counter() - start
+    print(f"{n} grids of {size}x{size}: loop {loop * 1000:.0f} ms, stacked {stacked * 1000:.0f} ms")
+    for name, ref, got in (('heat', heat, heat_s), ('waste', waste, waste_s), ('energy', energy, energy_s)):
+        print(f"  {name} max abs diff {np.abs(np.stack(ref) - to_numpy(got)).max():.2e}")
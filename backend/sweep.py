@@ -0,0 +1,64 @@
+import argparse
+import json
+import math
+import random
+import sys
+import numpy as np
+import climate
+from citygrid import as_grid
+from heat import simheat
+from energy import energy_matrix, energy_summary
+from waste import waste_field
+
+COLUMNS = ('yr', 'latitude', 'longitude', 'scenario', 'airtemp', 'random_airtemp',
+           'heat_max', 'heat_min', 'heat_mean', 'waste_total', 'waste_max', 'waste_mean')
+
+def scenario_points(scenarios):
+    # (year, lat, lon, scenario) tuples from request dicts, longitude shifted onto
+    # the dataset's 0-360 axis the same way /api/evaluate does it
+    return [(str(s['yr']), float(s['latitude']), float(s['longitude']) + 180, s.get('scenario') or climate.SCENARIO)
+            for s in scenarios]
+
+def run_sweep(grid, points, heat_params=None, waste_params=None):
+    # one layout against many climates. the heat update is linear in airtemp, so
+    # the field is simheat at 0 plus each airtemp; energy does not read the climate
+    # at all, and waste runs once over a leading scenario axis
+    city = as_grid(grid)
+    heat_params = heat_params or {}
+    waste_params = waste_params or {}
+    temps = np.array(climate.airtemps(points), dtype=float)
+    # same fallback as a single evaluation, flagged so it can be told apart
+    missing = np.isnan(temps)
+    temps[missing] = [random.randint(0, 40) for _ in range(int(missing.sum()))]
+
+    base = simheat(city, 0.0, **heat_params)[2]
+    fields = temps[:, None, None] + base
+    waste = waste_field(city, fields, **waste_params)
+    _, energy_stats = energy_summary(energy_matrix(city), city)
+
+    rows = []
+    for k, (year, lat, lon, scenario) in enumerate(points):
+        rows.append([year, lat, lon - 180, scenario, float(temps[k]), bool(missing[k]),
+                     float(fields[k].max()), float(fields[k].min()), float(fields[k].mean()),
+                     float(waste[k].sum()), float(waste[k].max()), float(waste[k].mean())])
+    return {"columns": list(COLUMNS), "rows": rows, "energy_stats": energy_stats}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate one layout across many years, locations and scenarios")
+    parser.add_argument("grid", help="json file with a list of rows of cell types, or an evaluate request body")
+    parser.add_argument("--lat", type=float, required=True)
+    parser.add_argument("--lon", type=float, required=True)
+    parser.add_argument("--years", nargs="+", default=["2016-2100"], help="years or ranges like 2016-2100")
+    parser.add_argument("--scenario", nargs="+", default=[climate.SCENARIO], help="CMIP6 experiments, e.g. ssp245 ssp585")
+    args = parser.parse_args()
+    with open(args.grid) as f:
+        layout = json.load(f)
+    if isinstance(layout, dict):
+        layout = [[cell["type"] for cell in row] for row in layout["grid"]]
+    scenarios = [{'yr': year, 'latitude': args.lat, 'longitude': args.lon, 'scenario': scenario}
+                 for scenario in args.scenario for year in climate.parse_years(args.years)]
+    table = run_sweep(layout, scenario_points(scenarios))
+    print(",".join(table["columns"]))
+    for row in table["rows"]:
+        print(",".join(f"{v:.4f}" if isinstance(v, float) and not math.isnan(v) else str(v) for v in row))
+    print("energy:", json.dumps(table["energy_stats"]), file=sys.stderr)
@@ -0,0 +1,323 @@
+import argparse
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+from citygrid import TYPES, DENSE, LIGHT, encode
+from colormap import colorize
+from heat import SOURCE, heat_steps, render_heat
+from waste import COEFFS, wastemaker, transfer_masks, ca_step_array
+from relax import relax
+from energy import energy_matrix, energy_stats_from, diffuse_energy, energy_colors
+
+# district sized layouts that do not fit in one request: the type grid and
+# every field live in .npy files on disk, and worker processes map the tile
+# they work on plus a halo around it. a tile is exact as long as the halo
+# covers everything its cells read over the steps it runs between exchanges.
+# cells a single step reads around each cell, per stencil:
+HALO = {
+    'heat': 1,
+    # rules 1 and 7 compare the running delta with the neighbor's, and each of
+    # the four direction passes widens what a delta depends on by one cell
+    'waste': 5,
+    # the 5x5 neighbourhood counts, one pass
+    'energy': 2,
+    'energy_diffusion': 1,
+}
+TILE = 512
+# steps between halo exchanges. more steps means fewer passes over the files
+# but a halo of HALO * SYNC cells that every tile computes redundantly
+SYNC = 8
+FIELDS = ('heat', 'waste', 'energy', 'energy_smoothed')
+
+def tiles(shape, size):
+    height, width = shape
+    return [(y, min(y + size, height), x, min(x + size, width))
+            for y in range(0, height, size) for x in range(0, width, size)]
+
+def window(box, halo, shape):
+    # box grown by halo and clipped to the grid, and where box sits inside that.
+    # clipped sides are the real grid edge, so the stencil's own edge rule applies
+    y0, y1, x0, x1 = box
+    wy0, wx0 = max(y0 - halo, 0), max(x0 - halo, 0)
+    wy1, wx1 = min(y1 + halo, shape[0]), min(x1 + halo, shape[1])
+    return (slice(wy0, wy1), slice(wx0, wx1)), (slice(y0 - wy0, y1 - wy0), slice(x0 - wx0, x1 - wx0))
+
+def rounds(steps, sync):
+    # steps split into exchanges of at most sync steps
+    return [min(sync, steps - done) for done in range(0, steps, sync)]
+
+def create(path, shape, dtype=np.float64):
+    np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape)).flush()
+    return path
+
+def mapped(path, write=False):
+    return np.load(path, mmap_mode='r+' if write else 'r')
+
+def extent(values, residual=0.0):
+    return float(values.max()), float(values.min()), float(values.sum()), residual
+
+# tile jobs, run in the worker processes. every one gets a box and a dict of
+# .npy paths and parameters, writes only inside its box and returns partial stats
+
+def store(box, job, values, info):
+    # the finished box into dst, with its extent and its last step's residual
+    y0, y1, x0, x1 = box
+    out = mapped(job['dst'], write=True)
+    out[y0:y1, x0:x1] = values
+    out.flush()
+    return extent(values, info['residual'])
+
+def heat_init(box, job):
+    y0, y1, x0, x1 = box
+    out = mapped(job['dst'], write=True)
+    out[y0:y1, x0:x1] = job['airtemp'] + SOURCE[mapped(job['types'])[y0:y1, x0:x1]]
+    out.flush()
+
+def heat_tile(box, job):
+    # same update as simheat, edge padding at the grid edge
+    shape = mapped(job['types']).shape
+    outer, inner = window(box, HALO['heat'] * job['steps'], shape)
+    output, info = heat_steps(mapped(job['src'])[outer], job['airtemp'], job['steps'], job['alpha'], job['beta'],
+                              region=inner)
+    return store(box, job, output[inner], info)
+
+def waste_init(box, job):
+    y0, y1, x0, x1 = box
+    out = mapped(job['dst'], write=True)
+    out[y0:y1, x0:x1] = wastemaker(mapped(job['types'])[y0:y1, x0:x1], mapped(job['heat'])[y0:y1, x0:x1])
+    out.flush()
+
+def waste_tile(box, job):
+    types = mapped(job['types'])
+    outer, inner = window(box, HALO['waste'] * job['steps'], types.shape)
+    masks = transfer_masks(np.array(types[outer]), job['coeffs'])
+
+    def step(w, out):
+        out[...] = ca_step_array(w, masks, job['coeffs'])
+    w, info = relax(step, mapped(job['src'])[outer], job['steps'], region=inner)
+    return store(box, job, w[inner], info)
+
+def energy_tile(box, job):
+    types = mapped(job['types'])
+    outer, inner = window(box, HALO['energy'], types.shape)
+    matrix = energy_matrix(np.array(types[outer]))[inner]
+    y0, y1, x0, x1 = box
+    out = mapped(job['dst'], write=True)
+    out[y0:y1, x0:x1] = matrix
+    out.flush()
+    codes = types[y0:y1, x0:x1]
+    low, high, positive = codes == LIGHT, codes == DENSE, matrix > 0
+    return {'total': matrix.sum(), 'low': matrix[low].sum(), 'high': matrix[high].sum(),
+            'low_count': int(low.sum()), 'high_count': int(high.sum()),
+            'positive': matrix[positive].sum(), 'positive_count': int(positive.sum())}
+
+def copy_tile(box, job):
+    y0, y1, x0, x1 = box
+    out = mapped(job['dst'], write=True)
+    out[y0:y1, x0:x1] = mapped(job['src'])[y0:y1, x0:x1]
+    out.flush()
+
+def extent_tile(box, job):
+    y0, y1, x0, x1 = box
+    return extent(mapped(job['src'])[y0:y1, x0:x1])
+
+def energy_diffusion_tile(box, job):
+    types = mapped(job['types'])
+    outer, inner = window(box, HALO['energy_diffusion'] * job['steps'], types.shape)
+    output, info = diffuse_energy(np.array(mapped(job['src'])[outer]), np.array(types[outer]), job['baseline'],
+                                  job['steps'], job['alpha'], job['beta'], region=inner)
+    return store(box, job, output[inner], info)
+
+def render_tile(box, job):
+    # the heatmaps with the whole city's value ranges, as (H, W, 3) uint8 arrays
+    y0, y1, x0, x1 = box
+    heat = mapped(job['heat'])[y0:y1, x0:x1]
+    waste = mapped(job['waste'])[y0:y1, x0:x1]
+    smoothed = mapped(job['energy_smoothed'])[y0:y1, x0:x1]
+    for name, image in (('heat_rgb', render_heat(heat, job['airtemp'])[0]),
+                        ('waste_rgb', colorize(waste, 'YlOrBr', *job['waste_range'])),
+                        ('energy_rgb', energy_colors(smoothed, *job['energy_range']))):
+        out = mapped(job[name], write=True)
+        out[y0:y1, x0:x1] = image
+        out.flush()
+
+class TiledRun:
+    # one layout .npy through heat, waste and energy tile by tile. fields end up
+    # as out_dir/<field>.npy, which np.load(..., mmap_mode='r') opens without
+    # reading them, next to a manifest.json with the stats
+    def __init__(self, types_path, out_dir, tile=TILE, sync=SYNC, workers=None, tol=None):
+        self.types = types_path
+        self.shape = mapped(types_path).shape
+        self.out_dir = out_dir
+        self.tile = tile
+        self.sync = sync
+        # checked at every exchange against the largest residual of any tile
+        self.tol = tol
+        self.boxes = tiles(self.shape, tile)
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.timings = {}
+        os.makedirs(out_dir, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.out_dir, name + '.npy')
+
+    def each_tile(self, fn, job):
+        # one pass over every tile, which is also the barrier between exchanges
+        return list(self.pool.map(fn, self.boxes, repeat(job)))
+
+    def iterate(self, name, fn, steps, job):
+        # double buffered: every exchange reads name.npy or name.next.npy and
+        # writes the other one, so no tile sees a neighbor's halo mid update
+        src, dst = self.path(name), create(self.path(name + '.next'), self.shape)
+        parts = None
+        done = 0
+        for count in rounds(steps, self.sync):
+            parts = self.each_tile(fn, dict(job, src=src, dst=dst, steps=count))
+            src, dst = dst, src
+            done += count
+            if self.tol is not None and max(p[3] for p in parts) < self.tol:
+                break
+        if src != self.path(name):
+            os.replace(src, self.path(name))
+        else:
+            os.remove(dst)
+        if parts is None:
+            parts = self.each_tile(extent_tile, {'src': self.path(name)})
+        return dict(self.summarize(parts), steps=done, residual=max(p[3] for p in parts))
+
+    def timed(self, name, fn):
+        start = time.perf_counter()
+        result = fn()
+        self.timings[name] = round(time.perf_counter() - start, 3)
+        return result
+
+    def heat(self, airtemp, steps=75, alpha=0.01, beta=0.01):
+        create(self.path('heat'), self.shape)
+        job = {'types': self.types, 'airtemp': airtemp, 'alpha': alpha, 'beta': beta}
+        self.each_tile(heat_init, dict(job, dst=self.path('heat')))
+        return self.iterate('heat', heat_tile, steps, job)
+
+    def waste(self, steps=10, coeffs=COEFFS):
+        create(self.path('waste'), self.shape)
+        self.each_tile(waste_init, {'types': self.types, 'heat': self.path('heat'), 'dst': self.path('waste')})
+        return self.iterate('waste', waste_tile, steps, {'types': self.types, 'coeffs': coeffs})
+
+    def energy(self, steps=50, alpha=0.02, beta=0.01):
+        create(self.path('energy'), self.shape)
+        parts = self.each_tile(energy_tile, {'types': self.types, 'dst': self.path('energy')})
+        total = {key: sum(part[key] for part in parts) for key in parts[0]}
+        stats = energy_stats_from(total['total'], total['low'], total['high'], total['low_count'], total['high_count'])
+        # the diffusion pulls everything towards the mean of the whole city
+        baseline = total['positive'] / total['positive_count'] if total['positive_count'] else 0
+        create(self.path('energy_smoothed'), self.shape)
+        self.each_tile(copy_tile, {'src': self.path('energy'), 'dst': self.path('energy_smoothed')})
+        smoothed = self.iterate('energy_smoothed', energy_diffusion_tile, steps,
+                                {'types': self.types, 'baseline': baseline, 'alpha': alpha, 'beta': beta})
+        return stats, smoothed
+
+    def render(self, airtemp, waste, smoothed):
+        job = {name: self.path(name) for name in FIELDS}
+        for name in ('heat_rgb', 'waste_rgb', 'energy_rgb'):
+            job[name] = create(self.path(name), self.shape + (3,), np.uint8)
+        job.update(airtemp=airtemp, waste_range=(waste['min'], waste['max']),
+                   energy_range=(smoothed['min'], smoothed['max']))
+        self.each_tile(render_tile, job)
+
+    def summarize(self, parts):
+        cells = self.shape[0] * self.shape[1]
+        return {'max': max(p[0] for p in parts), 'min': min(p[1] for p in parts),
+                'mean': sum(p[2] for p in parts) / cells, 'total': sum(p[2] for p in parts)}
+
+    def close(self):
+        self.pool.shutdown()
+
+def simulate(types_path, out_dir, airtemp, heat_params=None, waste_params=None, tile=TILE, sync=SYNC,
+             workers=None, render=False, tol=None):
+    # the whole evaluate pipeline minus the diffusion image, returns the manifest
+    heat_params = heat_params or {}
+    waste_params = waste_params or {}
+    run = TiledRun(types_path, out_dir, tile, sync, workers, tol)
+    try:
+        heat = run.timed('heat', lambda: run.heat(airtemp, **heat_params))
+        waste = run.timed('waste', lambda: run.waste(**waste_params))
+        energy_stats, smoothed = run.timed('energy', run.energy)
+        if render:
+            run.timed('render', lambda: run.render(airtemp, waste, smoothed))
+    finally:
+        run.close()
+    manifest = {
+        'shape': list(run.shape), 'tile': tile, 'sync': sync, 'tol': tol, 'halo': HALO, 'airtemp': airtemp,
+        'heat_params': heat_params, 'waste_params': waste_params,
+        'fields': {name: os.path.basename(run.path(name)) for name in FIELDS + (('heat_rgb', 'waste_rgb', 'energy_rgb') if render else ())},
+        'heat_stats': heat, 'waste_stats': waste, 'energy_stats': energy_stats, 'energy_smoothed': smoothed,
+        'timings': run.timings,
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+def save_layout(grid, path):
+    # rows of type names (or an evaluate request body) as a uint8 code .npy
+    if isinstance(grid, dict):
+        grid = [[cell["type"] for cell in row] for row in grid["grid"]]
+    np.save(path, encode(grid))
+    return path
+
+def random_layout(size, path, block=8, seed=0):
+    # a blocky made up district, written band by band so it is never in memory whole
+    rng = np.random.default_rng(seed)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(size, size))
+    coarse = math.ceil(size / block)
+    for y in range(0, size, block * 64):
+        rows = min(block * 64, size - y)
+        codes = rng.integers(1, len(TYPES), size=(math.ceil(rows / block), coarse), dtype=np.uint8)
+        out[y:y + rows] = codes.repeat(block, 0).repeat(block, 1)[:rows, :size]
+    out.flush()
+    return path
+
+def check(types_path, out_dir, airtemp, heat_params, waste_params):
+    # the in-memory simulators on the same layout, largest difference per field
+    from heat import simheat
+    from waste import waste_field
+    from energy import apply_energy_diffusion
+    types = np.load(types_path)
+    heat = simheat(types, airtemp, **heat_params)[2]
+    matrix = energy_matrix(types)
+    reference = {'heat': heat, 'waste': waste_field(types, heat, **waste_params), 'energy': matrix,
+                 'energy_smoothed': apply_energy_diffusion(matrix, types)}
+    return {name: float(np.abs(mapped(os.path.join(out_dir, name + '.npy')) - field).max())
+            for name, field in reference.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run heat, waste and energy over a district sized layout in tiles")
+    parser.add_argument("layout", help=".npy of type codes, a json layout like sweep.py takes, or random:<size>")
+    parser.add_argument("out", help="directory for the field .npy files and manifest.json")
+    parser.add_argument("--airtemp", type=float, default=25.0)
+    parser.add_argument("--tile", type=int, default=TILE)
+    parser.add_argument("--sync", type=int, default=SYNC, help="steps between halo exchanges")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--tol", type=float, default=None, help="stop a field early once no cell moves by this much in a step")
+    parser.add_argument("--render", action="store_true", help="also write the heatmaps as (H, W, 3) uint8 .npy")
+    parser.add_argument("--check", action="store_true", help="compare against the in-memory simulators (small layouts only)")
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    layout = args.layout
+    if layout.startswith('random:'):
+        layout = random_layout(int(layout.split(':')[1]), os.path.join(args.out, 'layout.npy'))
+    elif not layout.endswith('.npy'):
+        with open(layout) as f:
+            layout = save_layout(json.load(f), os.path.join(args.out, 'layout.npy'))
+    # simulator defaults, the same numbers the backend runs with
+    start = time.perf_counter()
+    manifest = simulate(layout, args.out, args.airtemp, tile=args.tile, sync=args.sync,
+                        workers=args.workers, render=args.render, tol=args.tol)
+    print(f"{manifest['shape'][0]}x{manifest['shape'][1]} in {len(tiles(manifest['shape'], args.tile))} tiles: "
+          f"{time.perf_counter() - start:.2f} s {manifest['timings']}")
+    for key in ('heat_stats', 'waste_stats', 'energy_stats'):
+        print(key, json.dumps(manifest[key]))
+    if args.check:
+        print("max abs difference to the in-memory run:", check(layout, args.out, args.airtemp, {}, {}))
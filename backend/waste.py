@@ -1,24 +1,25 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from copy import deepcopy
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from colormap import colorize
 
-def wastemaker(grid, temp,baseline_temp=15,normaltrashperson=1.2,temp_coeff=0.015):
-    trasharea = {'d':500, 'l':50, 'g':0, 'b':0, 'empty':0} 
-    row, column = len(grid), len(grid[0])
-    waste = [[0.0]*column for _ in range(row)]
-    
-    for i in range(row):
-        for j in range(column):
-            p = trasharea[grid[i][j]]
-            adjustedperperson = normaltrashperson * (1 + temp_coeff*(temp[i][j] - baseline_temp))
-            waste[i][j] = p * adjustedperperson
-    return waste
+from citygrid import TYPES, EMPTY, DENSE, LIGHT, GREEN, WATER, TYPE_CODE, encode, as_grid
+from relax import relax, CHECK_EVERY
+neumannNeighbors = [(-1,0),(1,0),(0,-1),(0,1)] #only adjacent squares
+
+# trash per person at BASELINE_TEMP, and the share more per degree above it.
+# stack.py scales its batched fields with the same two temperature constants
+BASELINE_TEMP, TRASH_PER_PERSON, TEMP_COEFF = 15, 1.2, 0.015
+
+def wastemaker(grid, temp,baseline_temp=BASELINE_TEMP,normaltrashperson=TRASH_PER_PERSON,temp_coeff=TEMP_COEFF):
+    trasharea = np.zeros(len(TYPES))
+    trasharea[DENSE], trasharea[LIGHT] = 500, 50
+    types = grid if isinstance(grid, np.ndarray) else as_grid(grid).types
+    adjustedperperson = normaltrashperson * (1 + temp_coeff*(np.asarray(temp, dtype=float) - baseline_temp))
+    return trasharea[types] * adjustedperperson
 
 def ca_step(grid, waste, coeffs):
     row, column = len(grid), len(grid[0])
     delta = [[0.0]*column for _ in range(row)] #calcs delta given length of grid
-    neumannNeighbors = [(-1,0),(1,0),(0,-1),(0,1)] #only adjacent squares
     
     for i in range(row):
         for j in range(column):
@@ -74,32 +75,92 @@ def ca_step(grid, waste, coeffs):
                  for i in range(row)] # updates list
     return new_waste
 
-def run_ca_final(grid, temp, steps=10):
-    coeffs = {
-        'overflow': 0.1,
-        'housingrunoff': 0.05,
-        'litter': 0.03,
-        'greenspacerunoff': 0.10,
-        'watertrashbuildup': 0.01, 'waterdiffusion': 0.1, 'lighttrashspread':0.01, 'landdiffusion':0.01
-    }
-    w = wastemaker(grid, temp)
-    for _ in range(steps):
-        w = ca_step(grid, w, coeffs)
-      
-    w = np.array(w)
-  
-    fig, ax = plt.subplots()
-    height, width = w.shape
-    fig = plt.figure(figsize=(width / 100, height / 100), dpi=100)
-    ax = fig.add_axes([0, 0, 1, 1]) 
-    ax.imshow(w, cmap='YlOrBr', interpolation='nearest')
-    ax.axis('off') 
-    canvas = FigureCanvas(fig)
-    canvas.draw()
-    image = np.frombuffer(canvas.tostring_argb(), dtype=np.uint8).reshape((height, width, 4))
-    rgb_pixels = [[[int(pixel[1]), int(pixel[2]), int(pixel[3])] for pixel in row] for row in image]
-    plt.close(fig)
-    return (rgb_pixels,w)
+def shift(arr, di, dj, fill=0):
+    # value of the (di, dj) neighbor at every cell, fill where it falls off the grid.
+    # only the last two axes are the grid, anything in front is a batch
+    padded = np.pad(arr, [(0, 0)] * (arr.ndim - 2) + [(1, 1), (1, 1)], mode='constant', constant_values=fill)
+    h, w = arr.shape[-2:]
+    return padded[..., 1+di:1+di+h, 1+dj:1+dj+w]
+
+def transfer_table(coeffs):
+    # one coefficient per (source type, neighbor type) for the unconditional rules 2-6 and 8
+    table = np.zeros((len(TYPES), len(TYPES)))
+    table[[DENSE, LIGHT], WATER] = coeffs['housingrunoff'] #rule 2
+    table[[DENSE, LIGHT], GREEN] = coeffs['litter'] #rule 3
+    table[GREEN, WATER] = coeffs['greenspacerunoff'] #rule 4
+    table[WATER, [GREEN, LIGHT, DENSE]] = coeffs['watertrashbuildup'] #rule 5
+    table[WATER, WATER] = coeffs['waterdiffusion'] #rule 6
+    table[GREEN, GREEN] = coeffs['landdiffusion'] #rule 8
+    return table
+
+def transfer_masks(types, coeffs):
+    table = transfer_table(coeffs)
+    masks = []
+    for di, dj in neumannNeighbors:
+        neigh = shift(types, di, dj, fill=EMPTY)
+        inside = shift(np.ones(types.shape, dtype=bool), di, dj, fill=False)
+        masks.append({
+            'coef': np.where(inside, table[types, neigh], 0.0),
+            'overflow': inside & (types == DENSE) & (neigh == LIGHT), #rule 1
+            'lightspread': inside & (types == LIGHT) & (neigh == LIGHT), #rule 7
+        })
+    return masks
+
+def ca_step_array(waste, masks, coeffs):
+    # rules 2-6 and 8 only depend on the waste, so they are summed in one pass.
+    # rules 1 and 7 compare deltas, which the list version reads half way through
+    # its scan; here they see the full delta of the rules before them instead
+    delta = np.zeros_like(waste)
+    for (di, dj), m in zip(neumannNeighbors, masks):
+        flow = waste * m['coef']
+        delta -= flow
+        delta += shift(flow, -di, -dj)
+    for (di, dj), m in zip(neumannNeighbors, masks):
+        fire = m['overflow'] & (delta >= 100 + shift(delta, di, dj))
+        flow = np.where(fire, np.maximum(waste - shift(waste, di, dj), 0) * coeffs['overflow'], 0.0)
+        delta -= flow
+        delta += shift(flow, -di, -dj)
+    for (di, dj), m in zip(neumannNeighbors, masks):
+        fire = m['lightspread'] & (delta >= 50 + shift(delta, di, dj))
+        flow = np.where(fire, waste * coeffs['lighttrashspread'], 0.0)
+        delta -= flow
+        delta += shift(flow, -di, -dj)
+    return waste + delta
+
+COEFFS = {
+    'overflow': 0.1,
+    'housingrunoff': 0.05,
+    'litter': 0.03,
+    'greenspacerunoff': 0.10,
+    'watertrashbuildup': 0.01, 'waterdiffusion': 0.1, 'lighttrashspread':0.01, 'landdiffusion':0.01
+}
+
+def ca_steps(types, waste, steps=10, coeffs=COEFFS, tol=None, every=CHECK_EVERY):
+    # ca_step_array from a given waste field, (field, info) like relax. stops early
+    # once no cell's waste moves by tol in a step
+    masks = transfer_masks(types, coeffs)
+
+    def step(w, out):
+        out[...] = ca_step_array(w, masks, coeffs)
+    return relax(step, waste, steps, tol, every)
+
+def waste_steps(grid, temp, steps=10, coeffs=COEFFS, tol=None, every=CHECK_EVERY):
+    # (field, info), on whichever kernel backend kernels.py picks for the grid
+    from kernels import run
+    types = as_grid(grid).types
+    return run('waste', wastemaker(types, temp), steps, types, coeffs, tol=tol, every=every)
+
+def waste_field(grid, temp, steps=10, coeffs=COEFFS, tol=None):
+    return waste_steps(grid, temp, steps, coeffs, tol)[0]
+
+def render_waste(w):
+    image = colorize(w, 'YlOrBr')
+    return (image,w)
+
+def run_ca_final(grid, temp, steps=10, tol=None):
+    # (image, field, info)
+    w, info = waste_steps(grid, temp, steps, tol=tol)
+    return render_waste(w) + (info,)
 
 land = [
         ['d','l','g','b'],
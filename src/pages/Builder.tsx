@@ -145,6 +145,7 @@ const Builder: React.FC = () => {
       yr,
       longitude,
       latitude,
+      format: 'raw',  // base64 typed buffers instead of nested pixel lists
       timestamp: new Date().toISOString(),
       evaluation: {
         status: 'complete',
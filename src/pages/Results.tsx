@@ -1,5 +1,5 @@
 import { useLocation } from 'react-router-dom';
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useMemo } from 'react';
 
 type GridCell = {
   color: string;
@@ -18,6 +18,42 @@ const colorFromType = (type: string) => {
   return match ? match.color : '#1f2937'; 
 };
 
+// compact responses send images and float fields as base64 typed buffers
+type EncodedArray = {
+  dtype: 'uint8' | 'float32';
+  shape: number[];
+  data: string;
+};
+
+const decodeArray = (field: EncodedArray): Uint8Array | Float32Array => {
+  const binary = atob(field.data);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return field.dtype === 'float32' ? new Float32Array(bytes.buffer) : bytes;
+};
+
+// rows of values, either the old nested lists or views into one typed array
+const toRows = (field?: number[][] | EncodedArray): ArrayLike<number>[] | undefined => {
+  if (!field || Array.isArray(field)) return field;
+  const [height, width] = field.shape;
+  const values = decodeArray(field);
+  return Array.from({ length: height }, (_, y) => values.subarray(y * width, (y + 1) * width));
+};
+
+const toPixelRows = (field?: number[][][] | EncodedArray): ArrayLike<number>[][] | undefined => {
+  if (!field || Array.isArray(field)) return field;
+  const [height, width] = field.shape;
+  const values = decodeArray(field);
+  return Array.from({ length: height }, (_, y) =>
+    Array.from({ length: width }, (_, x) => values.subarray((y * width + x) * 3, (y * width + x) * 3 + 3))
+  );
+};
+
+const toHex = (rgb: ArrayLike<number>) =>
+  `#${Array.from(rgb, v => v.toString(16).padStart(2, '0')).join('')}`;
+
 type TooltipContent = {
   row: number;
   col: number;
@@ -34,12 +70,12 @@ type TooltipContent = {
 
 export default function ResultsPage() {
   const { state } = useLocation();
-  const heatmap = state?.heatmap;
-  const heatstats = state?.heat_stats;
-  const energy_heatmap = state?.energy_heatmap;
+  const heatmap = useMemo(() => toPixelRows(state?.heatmap), [state]);
+  const heatstats = useMemo(() => toRows(state?.heat_stats), [state]);
+  const energy_heatmap = useMemo(() => toPixelRows(state?.energy_heatmap), [state]);
   const energy_stats = state?.energy_stats;
-  const pollution_heatmap = state?.pollution_heatmap;
-  const pollution_stats = state?.pollution_stats;
+  const pollution_heatmap = useMemo(() => toPixelRows(state?.pollution_heatmap), [state]);
+  const pollution_stats = useMemo(() => toRows(state?.pollution_stats), [state]);
   const heattemps = state?.heattemps;
   const gridSize = heatmap?.length || 32;
 
@@ -53,7 +89,7 @@ export default function ResultsPage() {
   }>({ visible: false, x: 0, y: 0, content: null, type: 'original' });
 
   const orgmap = state?.orgmap;
-  const difmap = state?.diffusionresult;
+  const difmap = useMemo(() => toPixelRows(state?.diffusionresult), [state]);
 
   const [grid, setGrid] = useState<GridCell[][]>(() =>
     Array(gridSize).fill(null).map(() =>
@@ -87,9 +123,9 @@ export default function ResultsPage() {
 
   useEffect(() => {
     if (heatmap) {
-      const newGrid = heatmap.map((row: number[][]) =>
-        row.map((rgb: number[]) => {
-          const hex = `#${rgb.map(v => v.toString(16).padStart(2, '0')).join('')}`;
+      const newGrid = heatmap.map((row: ArrayLike<number>[]) =>
+        row.map((rgb: ArrayLike<number>) => {
+          const hex = toHex(rgb);
           return {
             color: hex,
             type: 'heat'
@@ -99,9 +135,9 @@ export default function ResultsPage() {
       setGrid(newGrid);
     }
     if (pollution_heatmap) {
-      const newPollutionGrid = pollution_heatmap.map((row: number[][]) =>
-        row.map((rgb: number[]) => {
-          const hex = `#${rgb.map(v => v.toString(16).padStart(2, '0')).join('')}`;
+      const newPollutionGrid = pollution_heatmap.map((row: ArrayLike<number>[]) =>
+        row.map((rgb: ArrayLike<number>) => {
+          const hex = toHex(rgb);
           return {
             color: hex,
             type: 'pollution'
@@ -112,9 +148,9 @@ export default function ResultsPage() {
     }
 
     if (energy_heatmap) {
-      const newEnergyGrid = energy_heatmap.map((row: number[][]) =>
-        row.map((rgb: number[]) => {
-          const hex = `#${rgb.map(v => v.toString(16).padStart(2, '0')).join('')}`;
+      const newEnergyGrid = energy_heatmap.map((row: ArrayLike<number>[]) =>
+        row.map((rgb: ArrayLike<number>) => {
+          const hex = toHex(rgb);
           return {
             color: hex,
             type: 'energy'
@@ -124,9 +160,9 @@ export default function ResultsPage() {
       setEnergyGrid(newEnergyGrid);
     }
     if (difmap) {
-      const newDifGrid = difmap.map((row: number[][]) =>
-        row.map((rgb: number[]) => {
-          const hex = `#${rgb.map(v => v.toString(16).padStart(2, '0')).join('')}`;
+      const newDifGrid = difmap.map((row: ArrayLike<number>[]) =>
+        row.map((rgb: ArrayLike<number>) => {
+          const hex = toHex(rgb);
           return {
             color: hex,
             type: 'dif'